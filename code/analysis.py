@@ -1,19 +1,22 @@
-from playwright.sync_api import sync_playwright
-from bs4 import BeautifulSoup
-from user_agents import user_agents
 from dotenv import load_dotenv
 from openai import OpenAI
-import requests
+from output_format import DEFAULT_SETTINGS
+from page_artifact import PageArtifact
+import metrics
 import os
-import random
 import re
 import json
-
-agent = random.choice(user_agents)
+import time
+import tokens
 
 # this model is cheaper than gpt 4, still gives good output, and has json mode.
 CLIENT_MODEL = "gpt-3.5-turbo-1106"
 
+# the context window of CLIENT_MODEL, in tokens, and the part of it that is
+#  kept free for the model's answer
+CONTEXT_TOKENS = 16385
+RESPONSE_TOKENS = 1024
+
 
 def animate_client():
     """
@@ -25,30 +28,123 @@ def animate_client():
     return client
 
 
-def get_webtext(link, log):
+def get_pages(links, resources, limit, log):
     """
-    Gets the text of some webpage located at the given URL (the URL has
-    to be good). The returned text is sans html/css. If the text-getting
-    fails, an empty string is returned.
+    Gets a page_artifact.PageArtifact for each link, which every extractor
+    then shares. A page that someone else in the run already fetched (or is
+    fetching) is taken from the run's url registry. Every other link that is
+    not in the page cache is fetched at once by the fetcher, with at most
+    limit pages rendering together (a limit of 1 fetches them one after
+    another). The returned list is in the same order as links, and any link
+    that failed has an empty artifact (whose ok is False) in its place.
     """
+    registry = resources.get('url registry')
+    if registry is None:
+        return load_pages(links, resources, limit, log)
+
+    to_fetch, futures = registry.claim(links)
+    loaded = None
     try:
-        with sync_playwright() as p:
-            brow = p.chromium.launch(slow_mo=50)
-            page = brow.new_page(user_agent=agent)
-            page.goto(link)
-            bs = BeautifulSoup(page.content(), "html.parser")
-            webtext = bs.get_text().replace('\n', '').replace(
-                '"', '').replace("\xa0", '').strip()
-        return webtext
-    except Exception as e:
-        log.emit("<br>The webtext of " + link + " could not be gotten<br><br>")
-        return ""
+        loaded = load_pages(to_fetch, resources, limit, log)
+    finally:
+        # whoever is waiting on these links must never be left hanging, even
+        #  if loading them blew up
+        if loaded is None:
+            loaded = [PageArtifact.failed(link) for link in to_fetch]
+        for link, page in zip(to_fetch, loaded):
+            registry.resolve(link, page)
+    return [futures[link].result() for link in links]
+
+
+def load_pages(links, resources, limit, log):
+    """
+    Gets the pages of links from the page cache, or else the fetcher, without
+    looking at the url registry. See get_pages().
+    """
+    fetcher = resources['fetcher']
+    cache = resources['page cache']
+    run_metrics = resources.get('metrics')
+
+    pages = [None] * len(links)
+    to_render = []
+    for i, link in enumerate(links):
+        cached = None
+        if cache is not None:
+            cached = cache.lookup(link, resources['session'])
+        if cached is None:
+            to_render.append(i)
+        else:
+            pages[i] = PageArtifact(link, cached['html'], text=cached['text'])
+    if run_metrics is not None:
+        run_metrics.count("pages_from_page_cache", len(links) - len(to_render))
+
+    to_render_links = [links[i] for i in to_render]
+    if limit > 1 and len(to_render) > 1:
+        rendered = fetcher.fetch_many(to_render_links, limit)
+    else:
+        rendered = []
+        for link in to_render_links:
+            try:
+                rendered.append(fetcher.fetch(link))
+            except Exception as e:
+                rendered.append(e)
+
+    # with a parse pool, the new pages are all parsed at once in other
+    #  processes; otherwise each is parsed here when its text is asked for
+    parse_start = time.perf_counter()
+    extracted = [None] * len(rendered)
+    parse_pool = resources.get('parse pool')
+    if parse_pool is not None:
+        good = [j for j, page in enumerate(rendered)
+                if not isinstance(page, Exception)]
+        for j, result in zip(good, parse_pool.extract(
+                [rendered[j]['html'] for j in good])):
+            extracted[j] = result
+    parse_seconds = time.perf_counter() - parse_start
+
+    for i, page, parsed in zip(to_render, rendered, extracted):
+        try:
+            if isinstance(page, Exception):
+                raise page
+            if isinstance(parsed, Exception):
+                raise parsed
+            pages[i] = PageArtifact.from_page(links[i], page, parsed)
+            # the text is worked out now so that a page that cannot be parsed
+            #  counts as failed
+            parse_start = time.perf_counter()
+            pages[i].text
+            parse_seconds += time.perf_counter() - parse_start
+        except Exception:
+            log.emit("<br>The webtext of " + links[i] + " could not be" \
+                     " gotten<br><br>")
+            pages[i] = PageArtifact.failed(links[i])
+            if run_metrics is not None:
+                run_metrics.count("page_errors")
+            continue
+        if run_metrics is not None:
+            run_metrics.count("page_bytes", len(page['html']))
+        # only good pages are kept, so that an error page is not served back
+        #  in place of the real one on later runs
+        if cache is not None and (page.get('status') or 200) < 400:
+            cache.store(links[i], page, pages[i].text)
+    if run_metrics is not None and rendered:
+        run_metrics.observe("parse", parse_seconds)
+    return pages
 
 ##### MAKE SURE TO CHECK FOR OPENAI ERRORS, SEE https://github.com/openai/openai-python
-def generate_response(client, prompt_list, webtext, person, log):
+def generate_response(client, prompt_list, webtext, person, log, cache=None,
+                      json_mode=False, run_metrics=None):
     """
     Gets a response item from an openai client based off of text from some website
     and a given prompt. If the response-getting fails, bad_output() is returned.
+
+    cache: an llm_cache.LlmCache. If given, a prompt/webtext pair that was
+     already sent to CLIENT_MODEL is answered from it without calling openai,
+     and new responses are saved to it.
+    json_mode: if True, openai's json mode is used, which guarantees that
+     the response is a single JSON object. Used for fused prompts.
+    run_metrics: the run's metrics.Metrics, which times each openai call and
+     counts the tokens it used, if given
     """
 
     output = {}
@@ -57,27 +153,53 @@ def generate_response(client, prompt_list, webtext, person, log):
         prompt = prompt.replace("INSTITUTION_NAME", person['institution'])
 
         try:
-            response = client.chat.completions.create(
-                model = CLIENT_MODEL,
-                messages = [
-                    {"role": "system", "content": prompt},
-                    {"role": "user", "content": webtext}
-                ]
-            )
-
-            # openai will return a dictionary if the response fails on their
-            #   end for some reason.
-            if isinstance(response, dict):
-                log.emit("<br><br><br>GPT failed to properly analyze the current"\
-                         " webtext. Here is OpenAI's reasoning:<br>" \
-                         + str(response))
-            # else, if the response is good, return the text gpt generated
-            #   as a dictionary (additional checks are preformed
-            #   by this function).
+            content = None
+            if cache is not None:
+                content = cache.get(CLIENT_MODEL, prompt, webtext)
+
+            if content is None:
+                extra = {}
+                if json_mode:
+                    extra['response_format'] = {"type": "json_object"}
+                with metrics.timed(run_metrics, "llm_call"):
+                    response = client.chat.completions.create(
+                        model = CLIENT_MODEL,
+                        messages = [
+                            {"role": "system", "content": prompt},
+                            {"role": "user", "content": webtext}
+                        ],
+                        **extra
+                    )
+                usage = getattr(response, 'usage', None)
+                if run_metrics is not None and usage is not None:
+                    run_metrics.count("llm_prompt_tokens",
+                                      usage.prompt_tokens)
+                    run_metrics.count("llm_completion_tokens",
+                                      usage.completion_tokens)
+
+                # openai will return a dictionary if the response fails on
+                #   their end for some reason.
+                if isinstance(response, dict):
+                    log.emit("<br><br><br>GPT failed to properly analyze the" \
+                             " current webtext. Here is OpenAI's" \
+                             " reasoning:<br>" + str(response))
+                    continue
+
+                content = response.choices[0].message.content
+                fresh = True
             else:
-                as_dict = conv_to_dict(response.choices[0].message.content,
-                                       person)
-                output = output | as_dict
+                fresh = False
+
+            # if the response is good, return the text gpt generated as a
+            #   dictionary (additional checks are preformed by this function).
+            as_dict = conv_to_dict(content, person)
+            # only responses that could be read are remembered, so that a bad
+            #  one is asked for again next time instead of replayed forever
+            parsed = isinstance(as_dict, dict) and \
+                not isinstance(as_dict.get("error"), Exception)
+            if fresh and parsed and cache is not None:
+                cache.put(CLIENT_MODEL, prompt, webtext, content)
+            output = output | as_dict
         except Exception as e:
             log.emit("<br><br><br>GPT failed to properly analyze the current" \
                      " webtext. Here is OpenAI's reasoning:<br>" + str(e)) 
@@ -110,7 +232,9 @@ def conv_to_dict(json_string, researcher):
         as_dict = json.loads(json_string)
         return as_dict
     except:
-        print("original conversion failed")
+        # nothing is printed here: the command line's stdout carries only its
+        #  JSON lines
+        pass
 
     # If the output fails for this basic check, the first assumption is that
     # the output may be in code format, ie 
@@ -135,6 +259,11 @@ def combine_dicts(to_combine, initial_data, user_specified_headers):
     """
     This will combine all the dicts into a single format (a string) for each
     of the requested headers.
+
+    Every dict is normalized (its keys lowercased) once, up front. Values are
+    then merged in the order they were found, with repeated strings dropped by
+    checking a set of the lowercased values already used, so the work grows
+    linearly with the number of values.
     """
     user_specified_headers = list(map(
         lambda x : x.lower(), user_specified_headers
@@ -144,6 +273,9 @@ def combine_dicts(to_combine, initial_data, user_specified_headers):
     if "other key notes" in user_specified_headers:
         user_specified_headers += ["awards recieved",
                                    "patents under their name"]
+
+    normalized = [{k.lower(): v for k, v in item.items()}
+                  for item in to_combine]
     
     total = {}
     for ush in user_specified_headers:
@@ -155,65 +287,147 @@ def combine_dicts(to_combine, initial_data, user_specified_headers):
         elif ush == "other key notes":
             total[ush] = ""
             continue
-        total[ush] = ""
-
-        for item in to_combine:
-            item = {k.lower(): v for k, v in item.items()}
-            if ush in item:
-                curr = item[ush]
-                print(curr)
-                if len(curr) == 0:
-                    continue
-                elif isinstance(curr, str) and \
-                     (curr == "NONE" or \
-                      curr.lower() in total[ush].lower()):
+
+        seen = set()
+        parts = []
+        for item in normalized:
+            if ush not in item:
+                continue
+            curr = item[ush]
+            if isinstance(curr, list):
+                # the email lists: only the entries not already used are kept,
+                #  and each of them, and the list as a whole, counts as used
+                kept = []
+                for c in map(str, curr):
+                    if c.lower() not in seen:
+                        seen.add(c.lower())
+                        kept.append(c)
+                curr = "\n".join(kept)
+                seen.add(curr.lower())
+            else:
+                # gpt sometimes answers with a bare number or true/false
+                curr = str(curr)
+                if curr == "NONE" or curr.lower() in seen:
                     continue
-                elif isinstance(curr, list):
-                    curr = "\n".join(curr)
+                seen.add(curr.lower())
+            if len(curr) == 0:
+                continue
+            parts.append(curr)
 
-                total[ush] += "\n" + curr
+        total[ush] = "".join("\n" + part for part in parts)
 
     return total
 
 
-def get_email(webtext, link):
+def get_email(page):
     """
-    Regex is used to parse webtext looking for emails, looking through anchor
+    Regex is used to parse a page looking for emails, looking through anchor
     tags. The return is a list of found emails
-    """
-    agent = random.choice(user_agents)
-    try:
-        req = requests.get(link, agent)
-    except:
-        print("THERE WAS AN ERROR IN GET_EMAIL")
-        return []
-    bs = BeautifulSoup(req.content, 'html.parser')
 
-    anchors = bs.select("a")
-    to_analyze = [txt.string for txt in anchors \
-                  if txt.string is not None]
+    page: the page_artifact.PageArtifact of the link, the same one whose text
+     is given to gpt, so the page is not downloaded a second time
+    """
+    to_analyze = [string for href, string in page.anchors \
+                  if string is not None]
     to_analyze = " ".join(to_analyze)
     matches = re.findall(r'[\w+.\d-]*@[\w+.-]*', to_analyze)
     return matches
 
 
-def analyze(person, client, prompts, headers_from_user, need_email, log):
+def fetch_webtexts(person, resources, log,
+                   fetch_concurrency=DEFAULT_SETTINGS['fetch_concurrency']):
+    """
+    Gets the page of every link in person['links used'] and saves them, in
+    the same order as the links, as person['pages'], with their texts as
+    person['webtexts'].
+
+    resources: the dict built by main.start_resources()
+    fetch_concurrency: how many links are rendered at once. Above 1, all of
+     the person's pages are fetched together, otherwise they are fetched one
+     after another.
+    """
+    person['pages'] = get_pages(person['links used'], resources,
+                                fetch_concurrency, log)
+    person['webtexts'] = [page.text for page in person['pages']]
+    return person
+
+
+def extract_emails(person, parse_pool=None):
     """
-    When given a researcher dict and an instance of an openai client, this
-    will return a fully completed dict with all of the needed output. If
-    there is no good output for some reason, this will return a dict created
-    by bad_output().
+    Finds the emails on each of the person's links, saved in link order as
+    person['emails']. fetch_webtexts() has to be called first.
+
+    parse_pool: a parse_pool.ParsePool. If given, the pages whose anchors
+     were not found yet (such as pages from the page cache) are parsed in it
     """
-    skip_gpt = prompts[0] == "NONE"
-    all_output = []
+    if parse_pool is not None:
+        to_parse = [page for page in person['pages']
+                    if page.ok and not page.anchors_ready]
+        for page, anchors in zip(to_parse, parse_pool.anchors(
+                [page.html for page in to_parse])):
+            # a page the pool could not parse is tried again here
+            if not isinstance(anchors, Exception):
+                page.anchors = anchors
+    person['emails'] = [get_email(page) for page in person['pages']]
+    return person
 
-    for link in person['links used']:
-        webtext = get_webtext(link, log)
-        if need_email:
-            all_output.append({"email": get_email(webtext, link)})
-        if not skip_gpt:
-            all_output.append(generate_response(client, prompts, webtext,
-                                                person, log))
+
+def analyze_webtexts(person, client, prompts, log, cache=None,
+                     fused_prompt=None, fused_budget=None,
+                     token_budget=DEFAULT_SETTINGS['token_budget'],
+                     run_metrics=None):
+    """
+    Has gpt analyze each of the person's webtexts, saving the output for each
+    link in link order as person['gpt output']. fetch_webtexts() has to be
+    called first.
+
+    cache: the llm_cache.LlmCache given to generate_response(), if any
+    fused_prompt: all of the prompts combined into one, made by
+     output_format.fuse_prompts(). If given, each page is sent once with it,
+     in json mode, rather than once per prompt.
+    fused_budget: the most tokens the fused prompt and a webtext may add up
+     to. Pages over it fall back to the split prompts, whose smaller
+     requests (and answers) are less likely to run past the context window.
+    token_budget: the most tokens of each webtext that are sent. Longer
+     webtexts are trimmed to the chunks that best mention the person, so
+     that the cost and time of every request is predictable.
+    run_metrics: the metrics.Metrics given to generate_response(), if any
+    """
+    if fused_budget is None:
+        fused_budget = CONTEXT_TOKENS - RESPONSE_TOKENS
+    # the person's name and institution mark the useful parts of long pages
+    keywords = person['name'].split(" ") + [person['institution']]
+
+    if fused_prompt is not None:
+        fused_tokens = tokens.count_tokens(fused_prompt, CLIENT_MODEL)
+
+    person['gpt output'] = []
+    for webtext in person['webtexts']:
+        webtext = tokens.fit_to_budget(webtext, CLIENT_MODEL, token_budget,
+                                       keywords)
+        if fused_prompt is not None and fused_tokens + \
+           tokens.count_tokens(webtext, CLIENT_MODEL) <= fused_budget:
+            output = generate_response(client, [fused_prompt], webtext,
+                                       person, log, cache, json_mode=True,
+                                       run_metrics=run_metrics)
+        else:
+            output = generate_response(client, prompts, webtext, person, log,
+                                       cache, run_metrics=run_metrics)
+        person['gpt output'].append(output)
+    return person
+
+
+def build_output(person, headers_from_user):
+    """
+    Combines the emails and gpt output of every link (whichever of the two
+    were gathered) into the person's final output dict.
+    """
+    all_output = []
+    for i in range(len(person['links used'])):
+        if 'emails' in person:
+            all_output.append({"email": person['emails'][i]})
+        if 'gpt output' in person:
+            all_output.append(person['gpt output'][i])
 
     output = combine_dicts(
         all_output, person['data_from_csv'], headers_from_user
@@ -0,0 +1,296 @@
+"""
+Benchmarks whole runs offline. From the repository folder:
+
+    python code/bench_e2e.py [--people N] [options]
+
+A csv of N made up researchers is written, and main.main() scrapes it with
+every outside service replaced by the local stand-ins of bench_servers.py:
+searches go to a fake google, the pages found are on a static site farm,
+and openai is a mock server. Their latency, page sizes, and the mock's rate
+limit are flags, as are any of the format settings (the same flags as
+cli.py), so the effect of a setting can be measured without the network or
+an openai bill. Chromium is still started, as in a real run.
+
+When the run is done, the people scraped per minute, the p50 and p99 of
+every pipeline stage, and the peak memory (RSS) are printed. --json also
+saves them.
+
+    python code/bench_e2e.py --write-csv people.csv --people 100000
+
+only writes the csv, for use elsewhere.
+"""
+import argparse
+import csv
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import bench_servers
+import cli
+import output_format
+
+# the sizes of input the generator is meant for
+MIN_PEOPLE = 10
+MAX_PEOPLE = 100000
+
+FIRST_NAMES = ("Ada Alan Alice Amara Anil Ana Ben Carla Chen Daniel Diego"
+               " Elena Emeka Fatima Grace Hana Hiro Ibrahim Ines Ivan James"
+               " Jin Joao Julia Kai Karim Kenji Lars Leila Lucia Malik Maria"
+               " Mei Nadia Noah Olga Omar Priya Rafael Rosa Sara Sofia Tariq"
+               " Tomas Uma Victor Wei Yara Yusuf Zoe").split()
+LAST_NAMES = ("Abbott Alvarez Bauer Becker Castro Chowdhury Costa Dubois"
+              " Eriksen Farouk Fischer Garcia Gupta Hansen Hoffmann Ibarra"
+              " Ivanova Jensen Kato Khan Kowalski Larsen Lindqvist Mendes"
+              " Moreau Nakamura Novak Okafor Olsen Petrov Quinn Rahman Reyes"
+              " Rossi Sato Schmidt Silva Singh Sorensen Tanaka Torres Varga"
+              " Vogel Wagner Walsh Weber Xu Yamamoto Zhang Zielinski").split()
+INSTITUTIONS = ["Northfield University", "Lakeshore Institute of Technology",
+                "Eastbrook National Laboratory", "Westmoor College",
+                "Riverton State University", "Highland Research Center",
+                "Southgate Medical School", "Pinecrest Polytechnic",
+                "Stonebridge University", "Harborview Institute"]
+DOMAINS = ["Academia", "Government", "Industry"]
+
+# timers shown for each stage, in pipeline order, and then a few of the
+#  requests inside them (see metrics.Metrics)
+STAGE_TIMERS = ["stage_search", "stage_fetch", "stage_extract", "stage_llm",
+                "excel_write", "person"]
+REQUEST_TIMERS = ["search_request", "http_fetch", "page_render", "parse",
+                  "llm_call"]
+
+# settings every benchmark run starts from: nothing is read from or kept in
+#  the caches, the journal is not resumed, and the fake google is not paced
+#  like the real one. Flags given on the command line go over these
+BENCH_SETTINGS = {
+    'search_cache': False,
+    'page_cache': False,
+    'llm_cache': False,
+    'resume': False,
+    'search_rate': 1000.0,
+    'search_burst': 1000,
+}
+
+
+def write_people(path, rows, seed=0):
+    """
+    Writes a csv of rows made up researchers, with Name, Institution, and
+    Domain columns. The same seed always gives the same people.
+    """
+    rng = random.Random(seed)
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        out = csv.writer(f)
+        out.writerow(["Name", "Institution", "Domain"])
+        for _ in range(rows):
+            out.writerow([rng.choice(FIRST_NAMES) + " " +
+                          rng.choice(LAST_NAMES),
+                          rng.choice(INSTITUTIONS),
+                          rng.choice(DOMAINS)])
+
+
+def peak_rss():
+    """
+    return: the peak resident memory, in MB, of this process and of the
+     largest of its finished child processes (the parse pool), or None where
+     the resource module is missing (Windows)
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    # ru_maxrss is in bytes on macOS and in kilobytes everywhere else
+    unit = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return {
+        'self_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                         / unit, 1),
+        'children_mb': round(resource.getrusage(
+            resource.RUSAGE_CHILDREN).ru_maxrss / unit, 1)
+    }
+
+
+def start_servers(args):
+    farm = bench_servers.SiteFarm(args.page_latency / 1000,
+                                  page_kb=args.page_kb).start()
+    search = bench_servers.SearchServer(farm.url, args.search_latency / 1000,
+                                        results=args.results).start()
+    llm = bench_servers.MockOpenAI(args.llm_latency / 1000,
+                                   rpm=args.llm_rpm).start()
+    return {'farm': farm, 'search': search, 'llm': llm}
+
+
+def run(input_path, saved_format, folder, servers):
+    """
+    Runs main.main() on input_path with the servers standing in for google,
+    the web, and openai. Its log and table are written to bench.log.jsonl in
+    folder, along with the output and its metrics.
+
+    return: (whether the run finished, the seconds it took, the run's
+     metrics summary)
+    """
+    # the openai client reads these, and a proxy set in the environment must
+    #  not be used to reach the stand-ins
+    os.environ['OPENAI_BASE_URL'] = servers['llm'].url + "/v1"
+    os.environ['OPENAI_API_KEY'] = "bench"
+    no_proxy = os.environ.get('NO_PROXY', "")
+    os.environ['NO_PROXY'] = os.environ['no_proxy'] = \
+        "127.0.0.1" + ("," + no_proxy if no_proxy else "")
+
+    saved_format['settings']['search_url'] = servers['search'].url + \
+        "/search?q="
+    output_name = os.path.join(folder, "bench.xlsx")
+
+    # main pulls in playwright, openai, and the rest, so it is only imported
+    #  once the arguments are known to be good
+    import main
+    with open(os.path.join(folder, "bench.log.jsonl"), "w") as log_file:
+        log = cli.JsonLinesEmitter("log", out=log_file)
+        table = cli.JsonLinesEmitter("table", out=log_file)
+        start = time.time()
+        result = main.main(input_path, output_name, saved_format, log, table)
+        seconds = time.time() - start
+
+    summary = {}
+    try:
+        with open(output_name + ".metrics.json") as f:
+            summary = json.load(f)
+    except (OSError, ValueError):
+        pass
+    return result is None, seconds, summary
+
+
+def build_report(finished, seconds, summary, servers):
+    counters = summary.get('counters', {})
+    timers = summary.get('timers', {})
+    people = counters.get('people', 0)
+
+    def latencies(names):
+        return {name: {'count': timers[name]['count'],
+                       'p50': timers[name]['p50'],
+                       'p99': timers[name]['p99']}
+                for name in names if name in timers}
+
+    return {
+        'finished': finished,
+        'people': people,
+        'seconds': round(seconds, 2),
+        'people_per_minute': round(60 * people / seconds, 2) if seconds
+                             else 0,
+        'stages': latencies(STAGE_TIMERS),
+        'requests': latencies(REQUEST_TIMERS),
+        'peak_rss': peak_rss(),
+        'servers': {name: server.requests
+                    for name, server in servers.items()},
+        'llm_rate_limited': servers['llm'].limited,
+    }
+
+
+def print_report(report):
+    print(f"{report['people']} people in {report['seconds']} s:"
+          f" {report['people_per_minute']} people per minute"
+          + ("" if report['finished'] else " (the run did not finish)"))
+    for title in ("stages", "requests"):
+        print()
+        print(f"{title:<16} {'count':>8} {'p50 s':>10} {'p99 s':>10}")
+        for name, timer in report[title].items():
+            print(f"{name:<16} {timer['count']:>8} {timer['p50']:>10.3f}"
+                  f" {timer['p99']:>10.3f}")
+    print()
+    rss = report['peak_rss']
+    if rss is None:
+        print("peak RSS: not available on this platform")
+    else:
+        print(f"peak RSS: {rss['self_mb']} MB, largest child process"
+              f" {rss['children_mb']} MB")
+    print("requests served: " + ", ".join(
+        f"{name} {count}" for name, count in report['servers'].items()) +
+        f" ({report['llm_rate_limited']} turned away by the openai rate"
+        " limit)")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--people", type=int, default=100,
+                        help="how many people to make up (" + str(MIN_PEOPLE)
+                        + " to " + str(MAX_PEOPLE) + ")")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="the seed the people are made up from")
+    parser.add_argument("--input", help="scrape this csv instead of making"
+                        " one up")
+    parser.add_argument("--write-csv", metavar="PATH",
+                        help="only write the made up people to PATH")
+    parser.add_argument("--format", default="base",
+                        help="a saved format name or path, or 'base'")
+    parser.add_argument("--folder", help="where the csv, output, log, and"
+                        " metrics go. A temporary folder, deleted afterwards,"
+                        " if not given")
+    parser.add_argument("--json", metavar="PATH",
+                        help="also save the report to PATH")
+
+    group = parser.add_argument_group("stand-ins")
+    group.add_argument("--search-latency", type=float, default=300,
+                       help="milliseconds the fake google takes per search")
+    group.add_argument("--results", type=int, default=3,
+                       help="results per search that are about the person")
+    group.add_argument("--page-latency", type=float, default=100,
+                       help="milliseconds the site farm takes per page")
+    group.add_argument("--page-kb", type=int, default=30,
+                       help="the size of the text of each page")
+    group.add_argument("--llm-latency", type=float, default=1000,
+                       help="milliseconds the mock openai takes per request")
+    group.add_argument("--llm-rpm", type=int, default=3000,
+                       help="requests a minute the mock openai allows, 0 for"
+                       " no limit")
+    cli.add_settings_arguments(parser)
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+
+    if not MIN_PEOPLE <= args.people <= MAX_PEOPLE:
+        parser.error("--people has to be from " + str(MIN_PEOPLE) + " to " +
+                     str(MAX_PEOPLE))
+    if args.write_csv:
+        write_people(args.write_csv, args.people, args.seed)
+        print(f"{args.people} people written to {args.write_csv}")
+        return 0
+
+    format_path = cli.find_format(args.format)
+    if format_path is None:
+        parser.error("there is no saved format called " + args.format)
+    if args.input is not None and not os.path.isfile(args.input):
+        parser.error("the input file " + args.input + " does not exist")
+    saved_format = output_format.read_saved(format_path)
+    saved_format['settings'].update(BENCH_SETTINGS)
+    saved_format['settings'].update(cli.settings_from_args(args, parser))
+
+    folder = args.folder or tempfile.mkdtemp(prefix="scraper-bench-")
+    os.makedirs(folder, exist_ok=True)
+    input_path = args.input
+    if input_path is None:
+        input_path = os.path.join(folder, "people.csv")
+        write_people(input_path, args.people, args.seed)
+
+    servers = start_servers(args)
+    try:
+        finished, seconds, summary = run(input_path, saved_format, folder,
+                                         servers)
+    finally:
+        for server in servers.values():
+            server.close()
+        if args.folder is None:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    report = build_report(finished, seconds, summary, servers)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    return 0 if finished else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,90 @@
+"""
+Compares the html parsing backends on saved pages. From the repository
+folder:
+
+    python code/bench_parsing.py [folder] [--limit N] [--repeat N]
+
+The pages are the .html files in folder if one is given, otherwise the pages
+in the page cache (cache/pages.sqlite) that earlier runs rendered. For every
+backend three things are timed per page: the old path (a full soup, its
+get_text(), and selecting its anchors), parsing.anchors(), and parsing.text().
+"""
+import argparse
+import disk_cache
+import glob
+import json
+import os
+import parsing
+import time
+
+
+def load_pages(folder, limit):
+    if folder:
+        paths = sorted(glob.glob(os.path.join(folder, "*.html")))[:limit]
+        pages = []
+        for path in paths:
+            with open(path, encoding="utf-8", errors="replace") as f:
+                pages.append(f.read())
+        return pages
+
+    cache = disk_cache.DiskCache("pages", compress=True)
+    try:
+        return [json.loads(value)['html'] for value in cache.values(limit)]
+    finally:
+        cache.close()
+
+
+def full_soup(html, backend):
+    tree = parsing.parse(html, backend)
+    tree.get_text()
+    tree.select("a")
+
+
+def time_per_page(func, pages, backend, repeat):
+    """
+    return: the average milliseconds func took per page, over repeat passes
+    """
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for html in pages:
+            func(html, backend)
+    return 1000 * (time.perf_counter() - start) / (repeat * len(pages))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("folder", nargs="?",
+                        help="a folder of .html files to use instead of the"
+                        " page cache")
+    parser.add_argument("--limit", type=int, default=200,
+                        help="the most pages to use")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="how many times each page is parsed")
+    args = parser.parse_args()
+
+    pages = load_pages(args.folder, args.limit)
+    if not pages:
+        print("No saved pages were found.")
+        return
+    size = sum(len(html) for html in pages)
+    print(f"{len(pages)} pages, {size / len(pages) / 1024:.0f} KB on average")
+    print(f"{'backend':<12} {'full soup':>12} {'anchors':>12} {'text':>12}"
+          "   (ms per page)")
+
+    for backend in parsing.BACKENDS:
+        timings = [time_per_page(func, pages, backend, args.repeat)
+                   for func in (full_soup, parsing.anchors, parsing.text)]
+        print(f"{backend:<12}" + "".join(f" {t:>12.2f}" for t in timings))
+
+    # the backends should agree on what they pull out of every page
+    if len(parsing.BACKENDS) > 1:
+        differ = sum(
+            len({parsing.text(html, backend) for backend in parsing.BACKENDS})
+            > 1 for html in pages
+        )
+        print(f"{differ} of {len(pages)} pages get a different text from the"
+              " backends")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,281 @@
+"""
+Local stand-ins for the three services a run talks to, so that a whole run
+can be benchmarked offline (see bench_e2e.py):
+ SearchServer: answers /search?q=... with a google-like results page
+ SiteFarm: serves the pages those results link to
+ MockOpenAI: an OpenAI-compatible /v1/chat/completions
+
+Each one is a ThreadingHTTPServer on 127.0.0.1, run from a daemon thread, so
+requests are answered concurrently and a latency of a few hundred
+milliseconds does not hold up the other requests. Every response is made up
+from the request alone, with a random.Random seeded by it, so the same request
+always gets the same answer.
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, urlsplit
+import json
+import random
+import re
+import threading
+import time
+import rate_limit
+
+WORDS = ("research data model network analysis system learning method"
+         " theory study university laboratory department results paper"
+         " journal conference protein signal energy quantum climate policy"
+         " materials design sensor control language graph survey").split()
+
+# the fields asked for by a prompt: the quoted names after "the individual."
+#  (in the saved formats) or "the individual:" (output_format.build_prompts())
+_FIELDS = re.compile(r"individual[.:]\s*((?:'[^']+',?\s*)+)")
+_QUOTED = re.compile(r"'([^']+)'")
+
+
+def slug(text):
+    return "-".join(re.findall(r'[a-z0-9]+', text.lower()))
+
+
+def filler(rng, size):
+    """
+    Paragraphs of made up sentences, about size characters long.
+    """
+    paragraphs = []
+    length = 0
+    while length < size:
+        sentence = " ".join(rng.choice(WORDS) for _ in range(12))
+        paragraphs.append("<p>" + sentence.capitalize() + ".</p>")
+        length += len(sentence) + 8
+    return "\n".join(paragraphs)
+
+
+class _Server:
+    """
+    What the three servers share: starting, stopping, the latency of each
+    response, and counting the requests answered.
+
+    Attributes:
+     latency: seconds every response is held back for
+     jitter: how much the latency varies, as a fraction of it
+     url: http://127.0.0.1:<port>, once started
+     requests: how many requests were answered
+
+    Methods:
+     start: serves from a daemon thread, on a free port
+     close: stops serving
+    """
+
+    def __init__(self, latency, jitter=0.5):
+        self.latency = latency
+        self.jitter = jitter
+        self.url = None
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.server = None
+
+
+    def start(self):
+        owner = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # keep-alive, like the real services
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                owner._answer(self, None)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                owner._answer(self, self.rfile.read(length))
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = "http://127.0.0.1:" + str(self.server.server_address[1])
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        return self
+
+
+    def _answer(self, handler, body):
+        with self.lock:
+            self.requests += 1
+        if self.latency > 0:
+            spread = self.latency * self.jitter
+            time.sleep(max(0, self.latency + random.uniform(-spread, spread)))
+        status, content_type, content, headers = self.respond(handler.path,
+                                                              body)
+        content = content.encode("utf-8")
+        handler.send_response(status)
+        handler.send_header("Content-Type", content_type)
+        handler.send_header("Content-Length", str(len(content)))
+        for name, value in headers.items():
+            handler.send_header(name, value)
+        handler.end_headers()
+        handler.wfile.write(content)
+
+
+    def respond(self, path, body):
+        """
+        return: (status, content type, content, extra headers) for a request
+        """
+        raise NotImplementedError
+
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+class SiteFarm(_Server):
+    """
+    Static pages about people: /people/<slug>, /lab/<slug>, and
+    /researchgate/profile/<slug>, where slug is the person's search query.
+    Each page has page_kb of text and a mailto link, so both the email regex
+    and the llm stage have something to work on. Any other path is a short
+    page that nobody is selected for.
+    """
+
+    def __init__(self, latency=0.1, jitter=0.5, page_kb=30):
+        super().__init__(latency, jitter)
+        self.page_kb = page_kb
+
+
+    def respond(self, path, body):
+        path = urlsplit(path).path
+        rng = random.Random(path)
+        name = path.rstrip("/").rsplit("/", 1)[-1]
+        words = name.split("-")
+        email = ".".join(words[:2]) + "@example.edu"
+        size = self.page_kb * 1024 if len(words) > 1 else 2048
+
+        html = "<!DOCTYPE html><html><head><title>" + " ".join(words) + \
+            "</title></head><body><nav><a href=\"/\">Home</a> <a href=\"" + \
+            "/news/" + str(rng.randrange(1000)) + "\">News</a></nav><h1>" + \
+            " ".join(words).title() + "</h1><p>Contact: <a href=\"mailto:" + \
+            email + "\">" + email + "</a></p>" + filler(rng, size) + \
+            "</body></html>"
+        return 200, "text/html; charset=utf-8", html, {}
+
+
+class SearchServer(_Server):
+    """
+    Answers /search?q=... with a page laid out like google's results: every
+    result is a '/url?q=<link>&sa=U' anchor with a snippet under it. results
+    of them point at pages of the site farm about the person searched for
+    (which get_links() keeps) and the rest at pages it should drop, such as
+    social media, google's own links, and unrelated news. The page is padded
+    with inline script to page_kb, as google's is.
+    """
+
+    def __init__(self, farm_url, latency=0.3, jitter=0.5, results=3,
+                 page_kb=80):
+        super().__init__(latency, jitter)
+        self.farm_url = farm_url
+        self.results = results
+        self.page_kb = page_kb
+
+
+    def respond(self, path, body):
+        parts = urlsplit(path)
+        if parts.path != "/search":
+            return 404, "text/plain", "not found", {}
+        query = parse_qs(parts.query).get('q', [""])[0]
+        rng = random.Random(query)
+        person = slug(query)
+
+        good = [self.farm_url + "/people/" + person,
+                self.farm_url + "/lab/" + person,
+                self.farm_url + "/researchgate/profile/" + person]
+        good = [good[i % len(good)] + ("" if i < len(good) else
+                                       "?page=" + str(i))
+                for i in range(self.results)]
+        bad = ["https://www.facebook.com/" + person,
+               "/search?q=" + quote(query) + "&tbm=isch",
+               "https://www.google.com/preferences",
+               self.farm_url + "/news/" + str(rng.randrange(1000))]
+        links = good + bad
+        rng.shuffle(links)
+
+        results = []
+        for link in links:
+            href = link if link.startswith("/search") else \
+                "/url?q=" + quote(link, safe="") + "&sa=U&ved=" + \
+                str(rng.randrange(10 ** 9))
+            results.append("<div class=\"g\"><a href=\"" + href + "\"><h3>" +
+                           " ".join(rng.choice(WORDS) for _ in range(6)) +
+                           "</h3></a><div class=\"s\">" +
+                           " ".join(rng.choice(WORDS) for _ in range(30)) +
+                           "</div></div>")
+        html = "<!doctype html><html><head><title>" + query + \
+            " - Google Search</title></head><body><div id=\"search\">" + \
+            "\n".join(results) + "</div>"
+        padding = max(0, self.page_kb * 1024 - len(html))
+        html += "<script>var d=\"" + "x" * padding + "\";</script></body></html>"
+        return 200, "text/html; charset=utf-8", html, {}
+
+
+class MockOpenAI(_Server):
+    """
+    An OpenAI-compatible chat completions endpoint. Point the openai client
+    at it with OPENAI_BASE_URL=<url>/v1. Each response is a JSON object with
+    a made up value for every field the prompt asks for, and a usage block
+    that counts a token for every four characters.
+
+    Requests over the rate limit (rpm requests a minute, with bursts of up
+    to burst) are answered with a 429 and a Retry-After header, as openai
+    does, which the openai client backs off from and retries.
+
+    Attributes:
+     limited: how many requests were turned away by the rate limit
+    """
+
+    def __init__(self, latency=1.0, jitter=0.5, rpm=3000, burst=50):
+        super().__init__(latency, jitter)
+        self.bucket = rate_limit.TokenBucket(rpm / 60, burst) if rpm > 0 \
+            else None
+        self.limited = 0
+
+
+    def respond(self, path, body):
+        if not urlsplit(path).path.endswith("/chat/completions"):
+            return 404, "application/json", \
+                json.dumps({'error': {'message': "not found"}}), {}
+        if self.bucket is not None and not self.bucket.try_acquire():
+            with self.lock:
+                self.limited += 1
+            error = {'error': {'message': "Rate limit reached",
+                               'type': "requests",
+                               'code': "rate_limit_exceeded"}}
+            return 429, "application/json", json.dumps(error), \
+                {'Retry-After': "1"}
+
+        request = json.loads(body or b"{}")
+        messages = request.get('messages', [])
+        prompt = " ".join(str(m.get('content', "")) for m in messages
+                          if m.get('role') == "system")
+        sent = sum(len(str(m.get('content', ""))) for m in messages)
+
+        rng = random.Random(prompt)
+        fields = [field for group in _FIELDS.findall(prompt)
+                  for field in _QUOTED.findall(group)]
+        answer = {field: " ".join(rng.choice(WORDS) for _ in range(3))
+                  for field in fields}
+        content = json.dumps(answer)
+
+        response = {
+            'id': "chatcmpl-bench" + str(rng.randrange(10 ** 9)),
+            'object': "chat.completion",
+            'created': int(time.time()),
+            'model': request.get('model', "bench"),
+            'choices': [{'index': 0, 'finish_reason': "stop",
+                         'message': {'role': "assistant",
+                                     'content': content}}],
+            'usage': {'prompt_tokens': sent // 4,
+                      'completion_tokens': len(content) // 4,
+                      'total_tokens': sent // 4 + len(content) // 4}
+        }
+        return 200, "application/json", json.dumps(response), {}
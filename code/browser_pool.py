@@ -0,0 +1,464 @@
+from playwright.async_api import async_playwright
+from playwright.async_api import TimeoutError as PlaywrightTimeoutError
+from urllib.parse import urlsplit
+from user_agents import user_agents
+import asyncio
+import metrics
+import random
+import threading
+import time
+
+# how many chromium processes are kept warm for the whole run, and how many
+#  browser contexts each of them holds. browsers * contexts is the number of
+#  pages that can be open at the same time.
+BROWSER_COUNT = 2
+CONTEXTS_PER_BROWSER = 2
+
+# a browser is closed and relaunched after it has served this many pages; this
+#  keeps chromium's memory from creeping up over long runs
+PAGES_BEFORE_RECYCLE = 100
+
+# a browser that fails to relaunch is tried this many times, waiting
+#  LAUNCH_BACKOFF seconds before the second try and twice as long before each
+#  one after it. If every browser of the pool has failed, fetches fail instead
+#  of waiting for a browser that will never come
+LAUNCH_ATTEMPTS = 4
+LAUNCH_BACKOFF = 1.0
+
+# milliseconds before page.goto() gives up on a link
+NAVIGATION_TIMEOUT = 30000
+
+# pages are read once their html is parsed (domcontentloaded) and the network
+#  has been quiet, or this many milliseconds have gone by, whichever is first.
+#  Waiting for the full load event would wait for every last image and ad
+SETTLE_TIME = 1000
+
+# only the text of a page is kept, so these kinds of requests are never sent
+BLOCKED_RESOURCE_TYPES = {"image", "media", "font", "stylesheet"}
+
+# ad, analytics, and tracking hosts, whose requests are never sent either
+BLOCKED_HOSTS = [
+    "doubleclick.net", "googlesyndication.com", "googleadservices.com",
+    "google-analytics.com", "googletagmanager.com", "adservice.google.com",
+    "connect.facebook.net", "hotjar.com", "segment.io", "segment.com",
+    "mixpanel.com", "newrelic.com", "nr-data.net", "scorecardresearch.com",
+    "quantserve.com", "taboola.com", "outbrain.com", "criteo.com",
+    "adnxs.com", "amazon-adsystem.com", "clarity.ms", "fullstory.com",
+    "optimizely.com", "siteimproveanalytics.com", "addthis.com",
+    "sharethis.com", "crazyegg.com",
+]
+
+# blocked requests are never answered, so their size can only be guessed.
+#  These are rough average sizes, in bytes, of each kind of request
+ESTIMATED_BYTES = {
+    "image": 60000,
+    "media": 500000,
+    "font": 40000,
+    "stylesheet": 30000,
+    "script": 50000,
+}
+ESTIMATED_OTHER_BYTES = 5000
+
+
+class _BrowserEntry:
+    """
+    Bookkeeping for a single chromium process that lives inside the pool.
+
+    Attributes:
+     browser: the playwright Browser object
+     contexts: the BrowserContexts opened on the browser, one per slot
+     pages_served: how many pages have been opened since the last launch
+     in_use: how many of this browser's contexts are currently checked out
+     retiring: True once the browser has served enough pages or crashed; no
+      new pages are given out on it and it is relaunched once in_use is 0
+     generation: bumped on every launch so that slots belonging to a browser
+      that has since been replaced can be recognised and dropped
+     relaunching: True while the browser is being closed and launched again
+     failed: True once every attempt to relaunch the browser has failed
+    """
+
+    def __init__(self):
+        self.browser = None
+        self.contexts = []
+        self.pages_served = 0
+        self.in_use = 0
+        self.retiring = False
+        self.generation = 0
+        self.relaunching = False
+        self.failed = False
+
+
+class BrowserPool:
+    """
+    A long-lived pool of warm chromium browsers that is shared by everything
+    that renders webpages during a run. Playwright's async api is driven on
+    an event loop that runs in a background thread, so the pool can be used
+    from the Worker's thread (or any other thread) through the plain methods
+    below without each caller having to start playwright itself.
+
+    Attributes:
+     browser_count: the number of chromium processes kept open
+     contexts_per_browser: the number of contexts opened on each browser
+     pages_before_recycle: the page count after which a browser is relaunched
+     block_resources: whether requests of BLOCKED_RESOURCE_TYPES, and requests
+      to blocked hosts, are aborted
+     blocked_hosts: the hosts that are blocked, BLOCKED_HOSTS by default
+     settle_time: the most milliseconds to wait for the network to go quiet
+      after a page's html is parsed
+     run_metrics: the metrics.Metrics that page renders are timed into, if
+      any
+     blocked: a dict of resource type to how many requests of it were aborted
+     blocked_bytes: an estimate of the bytes those requests would have been
+     settle_seconds: the total time spent waiting for pages to settle
+     settle_timeouts: how many pages were read before their network was quiet
+     loop: the asyncio event loop that all playwright calls happen on
+     thread: the daemon thread running loop
+
+    Methods:
+     fetch: renders a single link and returns a dict describing the page
+     fetch_many: renders a list of links concurrently, keeping their order
+     page: an async context manager that checks a page out of the pool and
+      returns it afterwards. Only usable from coroutines running on loop
+     stats: a short string for the log
+     close: shuts down every browser, playwright, and the loop thread
+    """
+
+    def __init__(self, browser_count=BROWSER_COUNT,
+                 contexts_per_browser=CONTEXTS_PER_BROWSER,
+                 pages_before_recycle=PAGES_BEFORE_RECYCLE,
+                 block_resources=True, blocked_hosts=BLOCKED_HOSTS,
+                 settle_time=SETTLE_TIME, run_metrics=None):
+        self.browser_count = browser_count
+        self.contexts_per_browser = contexts_per_browser
+        self.pages_before_recycle = pages_before_recycle
+        self.block_resources = block_resources
+        self.blocked_hosts = tuple(host.lower() for host in blocked_hosts)
+        self.settle_time = settle_time
+        self.run_metrics = run_metrics
+        self.closed = False
+
+        # only ever touched on the loop thread, so they need no lock
+        self.blocked = {}
+        self.blocked_bytes = 0
+        self.settle_seconds = 0.0
+        self.settle_timeouts = 0
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever,
+                                       daemon=True)
+        self.thread.start()
+        self._run(self._start())
+
+
+    def _run(self, coro):
+        """
+        Runs a coroutine on the pool's loop and blocks until it is done.
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+
+    async def _start(self):
+        self.playwright = await async_playwright().start()
+        # the queue holds (entry, generation, context) slots that are free to
+        #  be used
+        self.slots = asyncio.Queue()
+        self.entries = []
+        for _ in range(self.browser_count):
+            entry = _BrowserEntry()
+            self.entries.append(entry)
+            await self._launch(entry)
+
+
+    async def _launch(self, entry):
+        """
+        (Re)launches the browser of some entry, and puts one slot per context
+        into the free queue.
+        """
+        entry.browser = await self.playwright.chromium.launch()
+        entry.browser.on("disconnected",
+                         lambda browser: self._mark_crashed(entry, browser))
+        entry.contexts = []
+        entry.pages_served = 0
+        entry.in_use = 0
+        entry.retiring = False
+        entry.generation += 1
+        for _ in range(self.contexts_per_browser):
+            context = await entry.browser.new_context(
+                user_agent=random.choice(user_agents)
+            )
+            context.set_default_navigation_timeout(NAVIGATION_TIMEOUT)
+            if self.block_resources:
+                await context.route("**/*", self._route)
+            entry.contexts.append(context)
+            self.slots.put_nowait((entry, entry.generation, context))
+
+
+    def _is_blocked(self, request):
+        if request.resource_type in BLOCKED_RESOURCE_TYPES:
+            return True
+        host = (urlsplit(request.url).hostname or "").lower()
+        return any(host == blocked or host.endswith("." + blocked)
+                   for blocked in self.blocked_hosts)
+
+
+    async def _route(self, route):
+        """
+        Called by playwright for every request a page makes. The page's own
+        document is always let through.
+        """
+        request = route.request
+        if (request.resource_type == "document"
+                and request.is_navigation_request()) \
+           or not self._is_blocked(request):
+            await route.continue_()
+            return
+        kind = request.resource_type
+        self.blocked[kind] = self.blocked.get(kind, 0) + 1
+        self.blocked_bytes += ESTIMATED_BYTES.get(kind, ESTIMATED_OTHER_BYTES)
+        await route.abort("blockedbyclient")
+
+
+    def _mark_crashed(self, entry, browser):
+        # closing an old browser during a relaunch also fires 'disconnected',
+        #  which must not retire its replacement
+        if not self.closed and browser is entry.browser:
+            entry.retiring = True
+
+
+    async def _recycle(self, entry):
+        """
+        Closes a retiring browser once none of its contexts are in use and
+        launches a fresh one in its place, trying again with backoff if the
+        launch fails. A browser that cannot be launched at all is given up
+        on, and once every browser has been, a marker is put in the free
+        queue that makes every waiting and later checkout fail.
+        """
+        if entry.relaunching or self.closed:
+            return
+        entry.relaunching = True
+        try:
+            error = None
+            for attempt in range(LAUNCH_ATTEMPTS):
+                try:
+                    await entry.browser.close()
+                except Exception:
+                    # a crashed browser may already be gone
+                    pass
+                if attempt > 0:
+                    await asyncio.sleep(LAUNCH_BACKOFF * 2 ** (attempt - 1))
+                try:
+                    await self._launch(entry)
+                    return
+                except Exception as e:
+                    error = e
+            # any slots of a half finished launch are dropped
+            entry.generation += 1
+            entry.retiring = True
+            entry.failed = True
+            if all(other.failed for other in self.entries):
+                self.slots.put_nowait((None, 0, error))
+        finally:
+            entry.relaunching = False
+
+
+    async def _checkout(self):
+        while True:
+            entry, generation, context = await self.slots.get()
+            # no browser could be launched; the marker is put back for the
+            #  other waiters, and context holds the launch error
+            if entry is None:
+                self.slots.put_nowait((entry, generation, context))
+                raise RuntimeError("no browser could be launched") \
+                    from context
+            # slots of a replaced browser are simply dropped, the relaunch
+            #  already put fresh ones into the queue
+            if generation != entry.generation:
+                continue
+            # slots of a retiring browser are dropped too; the browser is
+            #  relaunched (refilling the queue) once its last page is returned
+            if entry.retiring:
+                if entry.in_use == 0 and not entry.failed:
+                    await self._recycle(entry)
+                continue
+            entry.in_use += 1
+            entry.pages_served += 1
+            return entry, context
+
+
+    async def _checkin(self, entry, context, page, crashed):
+        try:
+            await page.close()
+        except Exception:
+            crashed = True
+        entry.in_use -= 1
+        if crashed or not entry.browser.is_connected() \
+           or entry.pages_served >= self.pages_before_recycle:
+            entry.retiring = True
+
+        if entry.retiring:
+            if entry.in_use == 0:
+                await self._recycle(entry)
+        else:
+            self.slots.put_nowait((entry, entry.generation, context))
+
+
+    async def _checkin_failed(self, entry, context):
+        """
+        Used when a page could not even be opened on a checked out context,
+        which means the browser is in a bad state.
+        """
+        entry.in_use -= 1
+        entry.retiring = True
+        if entry.in_use == 0:
+            await self._recycle(entry)
+
+
+    def page(self):
+        """
+        Used as `async with pool.page() as page:`. The page is closed and its
+        context given back to the pool when the block exits.
+        """
+        return _CheckedOutPage(self)
+
+
+    async def _fetch(self, link):
+        with metrics.timed(self.run_metrics, "page_render"):
+            async with self.page() as page:
+                response = await page.goto(link,
+                                           wait_until="domcontentloaded")
+                await self._settle(page)
+                html = await page.content()
+                return {
+                    'url': page.url,
+                    'status': response.status if response else None,
+                    'headers': await response.all_headers() if response \
+                        else {},
+                    'html': html
+                }
+
+
+    async def _settle(self, page):
+        """
+        Gives a page's scripts up to settle_time milliseconds to fill it in.
+        """
+        if self.settle_time <= 0:
+            return
+        start = time.monotonic()
+        try:
+            await page.wait_for_load_state("networkidle",
+                                           timeout=self.settle_time)
+        except PlaywrightTimeoutError:
+            self.settle_timeouts += 1
+        self.settle_seconds += time.monotonic() - start
+
+
+    def fetch(self, link):
+        """
+        Renders the page at link in one of the pool's browsers.
+
+        link: the URL to render
+        return: a dict containing
+         'url': the final URL after redirects
+         'status': the HTTP status of the main document, if there was one
+         'headers': the response headers of the main document
+         'html': the rendered DOM as a string
+        Any playwright error is raised to the caller.
+        """
+        return self._run(self._fetch(link))
+
+
+    async def _fetch_many(self, links, limit):
+        semaphore = asyncio.Semaphore(limit)
+
+        async def fetch_one(link):
+            async with semaphore:
+                try:
+                    return await self._fetch(link)
+                except Exception as e:
+                    return e
+
+        # gather keeps the results in the same order as links, no matter
+        #  which page finishes loading first
+        return await asyncio.gather(*[fetch_one(link) for link in links])
+
+
+    def fetch_many(self, links, limit):
+        """
+        Renders all of the given links at the same time, with at most limit
+        of them loading at once (the pool's size caps this as well).
+
+        links: a list of URLs to render
+        limit: the most pages to have open together
+        return: a list in the same order as links. Each item is either the
+         dict that fetch() would give for that link, or the exception that was
+         raised while rendering it
+        """
+        return self._run(self._fetch_many(links, limit))
+
+
+    def stats(self):
+        """
+        How many requests were blocked (with a guess of the bytes that saved)
+        and how long pages took to settle.
+        """
+        blocked = sum(self.blocked.values())
+        by_type = ", ".join(kind + ": " + str(count) for kind, count
+                            in sorted(self.blocked.items()))
+        return str(blocked) + " requests blocked" + \
+            (" (" + by_type + ")" if by_type else "") + ", about " + \
+            str(round(self.blocked_bytes / (1024 * 1024), 1)) + \
+            " MB not downloaded, " + str(round(self.settle_seconds, 1)) + \
+            " seconds spent settling, " + str(self.settle_timeouts) + \
+            " pages read before the network was quiet"
+
+
+    async def _shutdown(self):
+        for entry in self.entries:
+            try:
+                await entry.browser.close()
+            except Exception:
+                pass
+        await self.playwright.stop()
+
+
+    def close(self):
+        """
+        Shuts every browser down and stops the background loop. Safe to call
+        more than once.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self._run(self._shutdown())
+        finally:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.loop.close()
+
+
+class _CheckedOutPage:
+    """
+    The async context manager handed out by BrowserPool.page().
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+
+
+    async def __aenter__(self):
+        self.entry, self.context = await self.pool._checkout()
+        try:
+            self.page = await self.context.new_page()
+        except Exception:
+            await self.pool._checkin_failed(self.entry, self.context)
+            raise
+        return self.page
+
+
+    async def __aexit__(self, exc_type, exc, tb):
+        # an error is only treated as a crash if the browser itself went away;
+        #  a bad link should not cost a relaunch
+        crashed = exc is not None and not self.entry.browser.is_connected()
+        await self.pool._checkin(self.entry, self.context, self.page, crashed)
+        return False
@@ -0,0 +1,213 @@
+"""
+Runs a scrape without the GUI, for servers and scheduled jobs. From the
+repository folder:
+
+    python code/cli.py INPUT.csv FORMAT OUTPUT.xlsx [options]
+
+FORMAT is the name of a format in saved_output_formats/ (with or without
+.txt), the path of a saved format file, or "base" for the default format.
+Progress is written to stdout as JSON lines, one object per event:
+
+    {"event": "log", "message": "..."}
+    {"event": "indexed", "path": "..."}
+    {"event": "completed", "count": 3}
+    {"event": "finished", "ok": true, "seconds": 12.3}
+
+The exit code is 0 if the run finished, 1 if it stopped early, 2 if the
+arguments were bad, and 130 if it was interrupted.
+"""
+from html import unescape
+import argparse
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+# imported before main so that interface.py (and Qt) is never needed
+import output_format
+
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_BAD_ARGUMENTS = 2
+EXIT_INTERRUPTED = 130
+
+_BREAK = re.compile(r'<br\s*/?>|</h\d>|</p>', re.I)
+_TAG = re.compile(r'<[^>]+>')
+
+
+class JsonLinesEmitter:
+    """
+    Stands in for the GUI's pyqtSignal(str) objects. main.main() only ever
+    calls emit() on its log and table, so each emitted string is turned into
+    a JSON object and written as one line to out. Safe to share between
+    threads.
+
+    Attributes:
+     out: the text stream written to
+     kind: "log" if this replaces the log signal, "table" if it replaces the
+      table signal
+     fields: extra keys added to every event, such as the id of a shard
+      worker
+    """
+
+    lock = threading.Lock()
+
+    def __init__(self, kind, out=sys.stdout, fields=None):
+        self.kind = kind
+        self.out = out
+        self.fields = fields or {}
+
+
+    def write(self, event):
+        event = dict(self.fields, **event)
+        with self.lock:
+            self.out.write(json.dumps(event) + "\n")
+            self.out.flush()
+
+
+    def emit(self, message):
+        if self.kind == "table":
+            kind, _, value = message.partition(":")
+            if kind == "completed":
+                self.write({'event': "completed", 'count': int(value)})
+            elif kind == "index":
+                self.write({'event': "indexed", 'path': value})
+            return
+
+        # the log is html meant for the GUI; only its text is kept
+        text = unescape(_TAG.sub("", _BREAK.sub("\n", message)))
+        lines = [" ".join(line.split()) for line in text.split("\n")]
+        text = "\n".join(line for line in lines if line)
+        if text:
+            self.write({'event': "log", 'message': text})
+
+
+def find_format(name):
+    """
+    Gets the path of a saved format from its name or path, or None if there
+    is no such format.
+    """
+    if name == "base":
+        return output_format.DEFAULT_PATH
+    candidates = [name,
+                  os.path.join(output_format.SAVED_FOLDER, name),
+                  os.path.join(output_format.SAVED_FOLDER, name + ".txt")]
+    for path in candidates:
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        description="Scrape the people of a csv into an Excel file, without"
+        " the GUI. Progress is printed as JSON lines."
+    )
+    parser.add_argument("input", help="the input csv, with Name and"
+                        " Institution columns")
+    parser.add_argument("format", help="a saved format name or path, or"
+                        " 'base' for the default format")
+    parser.add_argument("output", help="the Excel file to write")
+    add_settings_arguments(parser)
+    group = parser.add_argument_group("limits")
+    group.add_argument("--limit", type=int,
+                       help="only scrape the first LIMIT people")
+    return parser
+
+
+def add_settings_arguments(parser):
+    """
+    Adds the flags that override format settings to parser; they are read
+    back with settings_from_args(). Shared with shard.py.
+    """
+    group = parser.add_argument_group("concurrency")
+    for name, text in [("search_workers", "people searched at once"),
+                       ("fetch_workers", "people whose pages are fetched at"
+                        " once"),
+                       ("llm_workers", "people analyzed by gpt at once"),
+                       ("fetch_concurrency", "pages of one person fetched at"
+                        " once"),
+                       ("browsers", "chromium browsers kept warm")]:
+        group.add_argument("--" + name.replace("_", "-"), type=int,
+                           dest=name, help=text)
+
+    group = parser.add_argument_group("caches")
+    for name in ["search_cache", "page_cache", "llm_cache", "http_first",
+                 "resume"]:
+        group.add_argument("--no-" + name.replace("_", "-"), dest=name,
+                           action="store_false", default=None,
+                           help="turn the " + name + " setting off")
+
+    group = parser.add_argument_group("rates and budgets")
+    group.add_argument("--search-rate", type=float, dest="search_rate",
+                       help="searches per second allowed to each host, 0"
+                       " for no limit")
+    group.add_argument("--token-budget", type=int, dest="token_budget",
+                       help="the most tokens of a page sent with a request")
+    group.add_argument("--set", action="append", default=[],
+                       metavar="KEY=VALUE",
+                       help="override any format setting (see"
+                       " output_format.DEFAULT_SETTINGS). Can be repeated")
+
+
+def settings_from_args(args, parser):
+    """
+    return: the settings the command line overrides, as a dict of name to
+     value, ready to be put over the format's own settings
+    """
+    overrides = {}
+    for name in output_format.DEFAULT_SETTINGS:
+        value = getattr(args, name, None)
+        if value is not None:
+            overrides[name] = value
+    for pair in args.set:
+        key, sep, value = pair.partition("=")
+        key = key.strip()
+        if not sep or key not in output_format.DEFAULT_SETTINGS:
+            parser.error("unknown setting in --set " + pair)
+        overrides[key] = value.strip()
+    return overrides
+
+
+def run(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    log = JsonLinesEmitter("log")
+    table = JsonLinesEmitter("table")
+
+    if not os.path.isfile(args.input):
+        parser.error("the input file " + args.input + " does not exist")
+    format_path = find_format(args.format)
+    if format_path is None:
+        parser.error("there is no saved format called " + args.format)
+    if args.limit is not None and args.limit < 1:
+        parser.error("--limit has to be at least 1")
+
+    saved_format = output_format.read_saved(format_path)
+    saved_format['settings'].update(settings_from_args(args, parser))
+
+    start = time.time()
+    try:
+        # main pulls in playwright, openai, and the rest, so it is only
+        #  imported once the arguments are known to be good
+        import main
+        result = main.main(args.input, args.output, saved_format, log, table,
+                           limit=args.limit)
+    except KeyboardInterrupt:
+        log.write({'event': "finished", 'ok': False, 'interrupted': True,
+                   'seconds': round(time.time() - start, 2)})
+        return EXIT_INTERRUPTED
+    except Exception as e:
+        log.write({'event': "error", 'message': repr(e)})
+        result = False
+
+    ok = result is None
+    log.write({'event': "finished", 'ok': ok,
+               'seconds': round(time.time() - start, 2)})
+    return EXIT_OK if ok else EXIT_FAILED
+
+
+if __name__ == "__main__":
+    sys.exit(run())
@@ -0,0 +1,102 @@
+from array import array
+import csv
+import io
+import locale
+
+
+class CsvIndex:
+    """
+    A byte-offset index of the records in a csv file. Building it reads the
+    file once, in binary, without parsing any fields or keeping any rows; only
+    the offset each record starts at is kept (8 bytes per record). Any record
+    can then be read on its own by seeking straight to it.
+
+    Records that span several lines (a quoted field holding a newline) are
+    handled by counting quote characters: a record ends at the first line
+    break where its quotes are balanced.
+
+    Attributes:
+     path: the path of the csv file
+     encoding: the encoding the file is read with. This defaults to the same
+      one open() uses, which is what the csv was always read with
+     header: the fields of the first record
+     offsets: an array holding the byte offset of every record after the
+      header
+
+    Methods:
+     __len__: the number of records, not counting the header
+     row: the fields of one record
+     rows: a generator of the fields of every record from some index onward
+    """
+
+    def __init__(self, path, encoding=None):
+        self.path = path
+        self.encoding = encoding or locale.getpreferredencoding(False)
+        self.offsets = array('Q')
+
+        with open(path, 'rb') as f:
+            header = self._read_record(f)
+            self.header = self._parse(header) if header else []
+            while True:
+                offset = f.tell()
+                record = self._read_record(f)
+                if not record:
+                    break
+                # blank lines are skipped by csv.reader, so they are here too
+                if record.strip():
+                    self.offsets.append(offset)
+
+
+    def __len__(self):
+        return len(self.offsets)
+
+
+    def _read_record(self, f):
+        """
+        Reads the raw bytes of one record (which may be several lines) from
+        the current position of the binary file f.
+        """
+        record = f.readline()
+        while record and record.count(b'"') % 2 == 1:
+            line = f.readline()
+            if not line:
+                break
+            record += line
+        return record
+
+
+    def _parse(self, record):
+        text = record.decode(self.encoding, errors='replace')
+        # a leading byte order mark would otherwise end up in the first field
+        text = text.lstrip('﻿')
+        return next(csv.reader(io.StringIO(text, newline='')), [])
+
+
+    def row(self, i):
+        """
+        The list of fields of record i (0 being the first record after the
+        header).
+        """
+        with open(self.path, 'rb') as f:
+            f.seek(self.offsets[i])
+            return self._parse(self._read_record(f))
+
+
+    def rows(self, start=0):
+        """
+        Yields (index, fields) for every record from start onward, reading the
+        file sequentially so that only one record is in memory at a time.
+        """
+        if start >= len(self.offsets):
+            return
+        with open(self.path, 'rb') as f:
+            f.seek(self.offsets[start])
+            i = start
+            while i < len(self.offsets):
+                record = self._read_record(f)
+                if not record:
+                    break
+                if not record.strip():
+                    continue
+                yield i, self._parse(record)
+                i += 1
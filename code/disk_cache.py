@@ -0,0 +1,192 @@
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+# every on-disk cache lives in this folder, next to saved_output_formats
+CACHE_FOLDER = "cache"
+
+# once a cache goes over its size limit, entries are evicted until it is
+#  down to this fraction of the limit, so that eviction happens in batches
+#  rather than on every put
+EVICT_TO = 0.9
+
+
+class DiskCache:
+    """
+    A persistent key/value cache kept in a single SQLite file. Entries expire
+    after a time-to-live, and once the cache holds more than its size limit
+    the least recently used entries are evicted. It is safe to share between
+    threads.
+
+    Attributes:
+     path: the SQLite file backing the cache
+     ttl: seconds an entry stays valid for. None means entries never expire
+     max_bytes: the total size of the stored values that the cache is kept
+      under
+     compress: if True, values are zlib compressed on disk (max_bytes then
+      applies to the compressed size)
+     hits: how many get() calls found a valid entry
+     misses: how many get() calls did not
+     total: the total size of the stored values, kept up to date as values
+      are stored and deleted rather than summed on every put
+
+    Methods:
+     get: returns the value stored under a key, or None
+     put: stores a value under a key, evicting old entries if needed
+     delete: removes a key from the cache
+     values: a generator of every stored value, for tools that read the cache
+     stats: a short string describing the hits and misses, for the log
+     close: closes the SQLite connection
+    """
+
+    def __init__(self, name, ttl=None, max_bytes=100 * 1024 * 1024,
+                 compress=False):
+        os.makedirs(CACHE_FOLDER, exist_ok=True)
+        self.path = os.path.join(CACHE_FOLDER, name + ".sqlite")
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.compress = compress
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        self.conn = sqlite3.connect(self.path, check_same_thread=False,
+                                    timeout=30)
+        # WAL lets several processes read the cache while one writes to it
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            " key TEXT PRIMARY KEY,"
+            " value BLOB NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " created REAL NOT NULL,"
+            " accessed REAL NOT NULL)"
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)"
+        )
+        self.conn.commit()
+        self.total = self._sum_sizes()
+
+
+    def _sum_sizes(self):
+        return self.conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM cache"
+        ).fetchone()[0]
+
+
+    def _delete(self, key):
+        """
+        Deletes key, keeping total up to date. Must be called with the lock
+        held.
+        """
+        row = self.conn.execute("SELECT size FROM cache WHERE key = ?",
+                                (key,)).fetchone()
+        if row is not None:
+            self.conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+            self.total -= row[0]
+
+
+    def get(self, key):
+        """
+        Returns the bytes stored under key, or None if there is nothing there
+        or the entry has expired.
+        """
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT value, created FROM cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and self.ttl is not None \
+               and now - row[1] > self.ttl:
+                self._delete(key)
+                self.conn.commit()
+                row = None
+
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.conn.execute("UPDATE cache SET accessed = ? WHERE key = ?",
+                              (now, key))
+            self.conn.commit()
+            self.hits += 1
+        if self.compress:
+            return zlib.decompress(row[0])
+        return row[0]
+
+
+    def put(self, key, value):
+        """
+        Stores value (bytes) under key, replacing anything already there.
+        """
+        now = time.time()
+        if self.compress:
+            value = zlib.compress(value)
+        with self.lock:
+            self._delete(key)
+            self.conn.execute(
+                "INSERT INTO cache VALUES (?, ?, ?, ?, ?)",
+                (key, value, len(value), now, now)
+            )
+            self.total += len(value)
+            if self.total > self.max_bytes:
+                self._evict()
+            self.conn.commit()
+
+
+    def _evict(self):
+        """
+        Deletes the least recently used entries until the cache is down to
+        EVICT_TO of max_bytes. Must be called with the lock held.
+        """
+        # other processes may share the file, so the real total is read once
+        #  here, where it decides what is deleted
+        self.total = self._sum_sizes()
+        if self.total <= self.max_bytes:
+            return
+        target = self.max_bytes * EVICT_TO
+        rows = self.conn.execute(
+            "SELECT key, size FROM cache ORDER BY accessed"
+        )
+        to_delete = []
+        for key, size in rows:
+            if self.total <= target:
+                break
+            to_delete.append((key,))
+            self.total -= size
+        self.conn.executemany("DELETE FROM cache WHERE key = ?", to_delete)
+
+
+    def delete(self, key):
+        with self.lock:
+            self._delete(key)
+            self.conn.commit()
+
+
+    def values(self, limit=None):
+        """
+        Yields the stored values (at most limit of them), newest first. This
+        does not count as using them, so it changes nothing about eviction.
+        """
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT value FROM cache ORDER BY created DESC LIMIT ?",
+                (-1 if limit is None else limit,)
+            ).fetchall()
+        for (value,) in rows:
+            yield zlib.decompress(value) if self.compress else value
+
+
+    def stats(self):
+        total = self.hits + self.misses
+        rate = 0 if total == 0 else round(100 * self.hits / total)
+        return str(self.hits) + " hits, " + str(self.misses) + " misses (" \
+            + str(rate) + "% hit rate)"
+
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
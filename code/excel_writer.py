@@ -0,0 +1,256 @@
+from openpyxl import Workbook
+import json
+import os
+import re
+import time
+
+# the rows appended so far are forced to disk after this many new rows, or
+#  once this many seconds have gone by since the last time, whichever comes
+#  first
+FLUSH_ROWS = 25
+FLUSH_SECONDS = 30
+
+# the Excel file itself is rebuilt from the rows at most this often while a
+#  run goes on, so that it is never far behind if the run is killed
+SAVE_SECONDS = 600
+
+
+class ExcelWriter:
+    """
+    Writes the output of a run. Saving a workbook costs time in proportion
+    to its size, so saving the whole workbook again for every batch of rows
+    makes a run slower and slower as it goes. Instead, the header and rows
+    are appended as JSON lines to a side file next to the output
+    (<output>.rows.jsonl), which is forced to disk in batches. The Excel file
+    is built from it, with a write-only workbook, every SAVE_SECONDS and once
+    more when the writer is closed.
+
+    The output file is written with only the header when the writer is made,
+    so an output that cannot be written is found before scraping starts.
+    Every save goes to a temporary file that then replaces the output file,
+    so the output on disk is always a complete workbook. If the run dies, the
+    rows written since the last save are still in the side file. A writer
+    that finds such a side file left behind first saves its rows to
+    <output name>.recovered.xlsx, before starting a side file of its own.
+    main.main() closes the writer whenever the run ends, including when it
+    stops because of an error.
+
+    Attributes:
+     path: the path of the output Excel file
+     header: the list of column names, the first row of the sheet
+     rows_path: the path of the side file
+     recovered: the path the rows of a side file left behind by an earlier
+      run were saved to, or None if there was none
+     rows: the number of rows appended, not counting the header
+     saved_rows: the number of those rows that are on disk
+
+    Methods:
+     append: adds a row, forcing the side file to disk, or saving the Excel
+      file, if either is due
+     flush: forces the side file to disk now
+     close: builds the Excel file from the side file, and removes it
+    """
+
+    def __init__(self, path, header, flush_rows=FLUSH_ROWS,
+                 flush_seconds=FLUSH_SECONDS, save_seconds=SAVE_SECONDS):
+        self.path = path
+        self.header = header
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self.save_seconds = save_seconds
+        self.rows_path = path + ".rows.jsonl"
+        self.recovered = None
+        self.rows = 0
+        self.saved_rows = 0
+
+        if os.path.exists(self.rows_path):
+            if _has_rows(self.rows_path):
+                recovered = os.path.splitext(path)[0] + ".recovered.xlsx"
+                _save(self.rows_path, recovered)
+                self.recovered = recovered
+            os.remove(self.rows_path)
+
+        self.side = open(self.rows_path, "w", encoding="utf-8")
+        self.side.write(json.dumps(header) + "\n")
+        self.flush()
+        try:
+            _save(self.rows_path, self.path)
+        except PermissionError:
+            self.side.close()
+            os.remove(self.rows_path)
+            raise
+        self.last_save = time.time()
+
+
+    def append(self, row):
+        """
+        Adds row to the side file. Raises PermissionError if a save of the
+        Excel file was due and the file is open somewhere else.
+        """
+        self.side.write(json.dumps(row) + "\n")
+        self.rows += 1
+        if self.rows - self.saved_rows >= self.flush_rows \
+           or time.time() - self.last_flush >= self.flush_seconds:
+            self.flush()
+        if time.time() - self.last_save >= self.save_seconds:
+            self.flush()
+            _save(self.rows_path, self.path)
+            self.last_save = time.time()
+
+
+    def flush(self):
+        self.side.flush()
+        os.fsync(self.side.fileno())
+        self.saved_rows = self.rows
+        self.last_flush = time.time()
+
+
+    def close(self):
+        """
+        Raises PermissionError if the output file is open somewhere else, in
+        which case the side file is kept.
+        """
+        if self.side.closed:
+            return
+        self.flush()
+        self.side.close()
+        _save(self.rows_path, self.path)
+        os.remove(self.rows_path)
+
+
+def _has_rows(rows_path):
+    """
+    Whether a side file holds anything past its header.
+    """
+    with open(rows_path, encoding="utf-8") as f:
+        f.readline()
+        return f.readline().strip() != ""
+
+
+def _save(rows_path, path):
+    """
+    Builds a workbook at path from a side file whose first line is the
+    header, streaming the rows rather than holding them all. A last line cut
+    short by a crash is skipped. Raises PermissionError if path is open
+    somewhere else.
+    """
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet()
+    with open(rows_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                ws.append(json.loads(line))
+            except ValueError:
+                continue
+
+    temp_path = path + ".tmp"
+    wb.save(temp_path)
+    try:
+        os.replace(temp_path, path)
+    except PermissionError:
+        os.remove(temp_path)
+        raise
+
+
+class RowFormatter:
+    """
+    Turns a person's output into a row of cells for a given header. It is
+    compiled once per run: each header is normalized and mapped to its column
+    index up front, so building a row only looks at each output value once,
+    instead of comparing every output key against every header cell.
+
+    'relevant links' and 'other key notes' are reserved columns. The first is
+    filled with the links found for the person, and the second with a
+    summary of the patents and awards found for them.
+
+    Attributes:
+     width: the number of columns
+     columns: a dict of lowercased column name to the indices of the columns
+      with that name, for every column that is not reserved
+     links_columns: the indices of the 'relevant links' columns
+     notes_columns: the indices of the 'other key notes' columns
+
+    Methods:
+     format: builds the row for one person
+    """
+
+    def __init__(self, header):
+        self.width = len(header)
+        self.columns = {}
+        self.links_columns = []
+        self.notes_columns = []
+        for col, name in enumerate(header):
+            name = name.lower()
+            if name == "relevant links":
+                self.links_columns.append(col)
+            elif name == "other key notes":
+                self.notes_columns.append(col)
+            else:
+                self.columns.setdefault(name, []).append(col)
+
+
+    def format(self, person):
+        """
+        person: a dict with the 'output' made by analysis.build_output() and
+         the 'links used' found by main.get_links()
+        return: the list of cell values, one per column. Columns with no
+         matching output are left as empty strings
+        """
+        output = person['output']
+        to_write = [""] * self.width
+        # a person with no output at all gets an empty row
+        if len(output) == 0:
+            return to_write
+
+        if "other key notes" in output:
+            output["other key notes"] = format_key_notes(output)
+
+        links = "\n".join(person['links used'])
+        for col in self.links_columns:
+            to_write[col] = links
+        for col in self.notes_columns:
+            to_write[col] = output.get("other key notes", "")
+
+        for key, data in output.items():
+            cols = self.columns.get(key.lower())
+            if cols is None:
+                continue
+            formatted = format_value(data)
+            for col in cols:
+                to_write[col] = formatted
+        return to_write
+
+
+def format_value(data):
+    """
+    Formats one output value for its cell: the blank lines at the start are
+    removed and any repeated lines are dropped, keeping the first of each.
+    """
+    items = data.split("\n")
+    while len(items) > 0 and items[0] == "":
+        del items[0]
+    # dict.fromkeys removes repetition of information while keeping the
+    #  lines in the order they were found
+    return "\n".join(dict.fromkeys(items))
+
+
+def format_key_notes(output):
+    """
+    Builds the 'other key notes' cell out of the patents and awards in some
+    person's output.
+    """
+    patents = "0"
+    awards = ""
+    if "patents under their name" in output:
+        patents = re.split(",|\n", output['patents under their name'])
+        if "" in patents:
+            patents.remove("")
+        patents = str(len(patents))
+    if "awards recieved" in output:
+        awards = re.split(",|\n", output['awards recieved'])
+        if "" in awards:
+            awards.remove("")
+        awards = "\n" + "\n".join(awards)
+
+    return f"Patents found: {patents} \n\n" \
+        f"Awards recieved found: {awards}"
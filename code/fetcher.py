@@ -0,0 +1,243 @@
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+from user_agents import user_agents
+import httpx
+import metrics
+import random
+import re
+import threading
+
+# seconds before a plain HTTP fetch gives up
+HTTP_TIMEOUT = 15
+
+# how many plain HTTP fetches can run at the same time
+HTTP_WORKERS = 8
+
+# a page whose visible text is shorter than this is taken to be a shell that
+#  javascript fills in, and is rendered by the browser instead
+MIN_TEXT_CHARS = 400
+
+# bits of html that single page apps leave in the page they are served as.
+#  Any of them (with too little text to be sure of the page) means the page
+#  needs the browser
+SPA_MARKERS = [
+    re.compile(rb'<div[^>]+id=["\'](?:root|app|__next|__nuxt)["\'][^>]*>'
+               rb'\s*</div>', re.I),
+    re.compile(rb'<app-root[^>]*>\s*</app-root>', re.I),
+    re.compile(rb'\bng-app\b', re.I),
+    re.compile(rb'(?:enable|requires?) javascript', re.I),
+]
+
+# the tags whose contents are not visible text
+_INVISIBLE = re.compile(rb'<(script|style|noscript|template)\b.*?</\1\s*>',
+                        re.I | re.S)
+_TAG = re.compile(rb'<[^>]*>')
+_SPACE = re.compile(rb'\s+')
+
+# a domain only has its pages sent straight to the browser once this many
+#  of them were confirmed to be javascript shells: the http page looked like
+#  one, and the rendered page had a lot more text than it
+PIN_AFTER_SHELLS = 3
+
+# the error statuses the browser might get past: bot checks, rate limits, and
+#  pages that are busy. Any other error is given back as the failed page the
+#  HTTP fetch got, since chromium would only get the same answer slower
+ESCALATE_STATUSES = {403, 429, 503}
+
+HTTP = "http"
+BROWSER = "browser"
+
+
+def visible_text_length(html):
+    """
+    A quick guess of how much visible text the raw html (as bytes) holds,
+    without building a tree.
+    """
+    text = _TAG.sub(b' ', _INVISIBLE.sub(b' ', html))
+    return len(_SPACE.sub(b' ', text).strip())
+
+
+def needs_browser(html):
+    """
+    Whether the html a plain HTTP fetch got looks like a javascript shell,
+    that is a page with very little text, or with very little more text than
+    a known single page app marker.
+
+    html: the body of the response, as bytes
+    """
+    length = visible_text_length(html)
+    if length < MIN_TEXT_CHARS:
+        return True
+    # a marker alone is not enough: plenty of server rendered pages still
+    #  mount an app on some element
+    return length < MIN_TEXT_CHARS * 3 and \
+        any(marker.search(html) for marker in SPA_MARKERS)
+
+
+class TieredFetcher:
+    """
+    Fetches pages with a plain, pooled HTTP client first, and only renders
+    them in the browser pool when that is needed. Most directory and lab
+    pages are static html that do not need chromium at all.
+
+    A page goes to the browser when the HTTP fetch fails, is turned away with
+    one of ESCALATE_STATUSES, does not give html, or gives something
+    needs_browser() takes to be a javascript shell. Any other error status is
+    given back as it is, as a page with that status. The
+    tier that worked is remembered per domain: once PIN_AFTER_SHELLS of a
+    domain's pages turned out to be real shells, its other pages go straight
+    to the browser, and once a domain has been served over HTTP, its pages
+    keep being tried over HTTP first. Failed fetches and short pages that
+    render to the same short text never count towards pinning a domain.
+
+    Attributes:
+     pool: the browser_pool.BrowserPool that pages are escalated to
+     client: the httpx.Client whose connections are reused for every fetch
+     tiers: a dict of domain to the tier that last worked for it
+     shells: a dict of domain to how many of its pages were confirmed to be
+      javascript shells since it was last served over HTTP
+     http_pages: how many pages were served over plain HTTP
+     browser_pages: how many pages were rendered by the browser
+     escalated: how many of those were tried over HTTP first
+     run_metrics: the metrics.Metrics that HTTP fetches are timed into, if
+      any
+
+    Methods:
+     fetch: fetches a single link and returns a dict describing the page
+     fetch_many: fetches a list of links concurrently, keeping their order
+     stats: a short string for the log
+     close: closes the HTTP client (the pool is closed by its owner)
+    """
+
+    def __init__(self, pool, http_workers=HTTP_WORKERS, run_metrics=None):
+        self.pool = pool
+        self.run_metrics = run_metrics
+        self.client = httpx.Client(
+            follow_redirects=True,
+            timeout=HTTP_TIMEOUT,
+            headers={'User-Agent': random.choice(user_agents)},
+            limits=httpx.Limits(max_connections=http_workers * 2,
+                                max_keepalive_connections=http_workers)
+        )
+        self.executor = ThreadPoolExecutor(max_workers=http_workers)
+        self.tiers = {}
+        self.shells = {}
+        self.lock = threading.Lock()
+        self.http_pages = 0
+        self.browser_pages = 0
+        self.escalated = 0
+
+
+    def _domain(self, link):
+        return urlsplit(link).netloc.lower()
+
+
+    def _fetch_http(self, link):
+        """
+        return: (page, shell_length) where page is the page dict for link if
+         plain HTTP was enough (or gave an error the browser would get too),
+         or None if it has to be rendered by the browser, and shell_length is the visible text length of the page if
+         it was sent to the browser for looking like a javascript shell (None
+         otherwise)
+        """
+        try:
+            with metrics.timed(self.run_metrics, "http_fetch"):
+                response = self.client.get(link)
+        except Exception:
+            return None, None
+        content_type = response.headers.get('content-type', '')
+        if response.status_code in ESCALATE_STATUSES:
+            return None, None
+        if response.status_code < 400:
+            if 'html' not in content_type.lower():
+                return None, None
+            if needs_browser(response.content):
+                return None, visible_text_length(response.content)
+        return {
+            'url': str(response.url),
+            'status': response.status_code,
+            'headers': dict(response.headers),
+            'html': response.text
+        }, None
+
+
+    def _is_shell(self, shell_length, page):
+        """
+        Whether a render confirmed that an http page was a javascript shell,
+        which is when the rendered page has a lot more text than the http one.
+        """
+        if shell_length is None or isinstance(page, Exception) \
+           or (page['status'] or 200) >= 400:
+            return False
+        rendered = visible_text_length(page['html'].encode("utf-8"))
+        return rendered >= max(MIN_TEXT_CHARS, 2 * shell_length)
+
+
+    def fetch(self, link):
+        """
+        Same as browser_pool.BrowserPool.fetch(), trying plain HTTP first.
+        """
+        result = self.fetch_many([link], 1)[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+    def fetch_many(self, links, limit):
+        """
+        Same as browser_pool.BrowserPool.fetch_many(). The links whose domain
+        is not known to need the browser are fetched over HTTP together
+        first, then every link that still needs it is rendered together.
+        """
+        results = [None] * len(links)
+        shell_lengths = [None] * len(links)
+        domains = [self._domain(link) for link in links]
+
+        tried = [i for i in range(len(links))
+                 if self.tiers.get(domains[i]) != BROWSER]
+        for i, (page, shell_length) in zip(tried, self.executor.map(
+                lambda i: self._fetch_http(links[i]), tried)):
+            results[i] = page
+            shell_lengths[i] = shell_length
+
+        to_render = [i for i in range(len(links)) if results[i] is None]
+        rendered = self.pool.fetch_many([links[i] for i in to_render],
+                                        limit) if to_render else []
+        for i, page in zip(to_render, rendered):
+            results[i] = page
+
+        confirmed = {i: self._is_shell(shell_lengths[i], results[i])
+                     for i in to_render}
+        with self.lock:
+            for i in range(len(links)):
+                if i not in to_render:
+                    # an error page says nothing about the tier the domain's
+                    #  pages need
+                    if results[i]['status'] < 400:
+                        self.tiers[domains[i]] = HTTP
+                        self.shells.pop(domains[i], None)
+                    self.http_pages += 1
+                    continue
+                self.browser_pages += 1
+                if i in tried:
+                    self.escalated += 1
+                # only a render that found the text the http page was missing
+                #  shows that the domain needs it; a dead link, a timeout, or
+                #  a page that is just short would be the same in either tier
+                if confirmed[i]:
+                    count = self.shells.get(domains[i], 0) + 1
+                    self.shells[domains[i]] = count
+                    if count >= PIN_AFTER_SHELLS:
+                        self.tiers[domains[i]] = BROWSER
+        return results
+
+
+    def stats(self):
+        return str(self.http_pages) + " pages over plain HTTP, " + \
+            str(self.browser_pages) + " rendered in the browser (" + \
+            str(self.escalated) + " after trying HTTP first)"
+
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.client.close()
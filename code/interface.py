@@ -1,14 +1,16 @@
 import os
 import main
 import output_format
+import csv_index
 from PyQt6.QtWidgets import (
     QApplication, QMainWindow, QGridLayout, QLineEdit, QFileDialog, QWidget,
     QPushButton, QTabWidget, QMessageBox, QVBoxLayout, QLabel, QComboBox,
-    QPlainTextEdit, QScrollArea, QHBoxLayout, QInputDialog, QTableWidget,
-    QTableWidgetItem
+    QPlainTextEdit, QScrollArea, QHBoxLayout, QInputDialog, QTableView
     )
 from PyQt6.QtGui import QPalette, QColor, QIcon, QPixmap
-from PyQt6.QtCore import Qt, QObject, QThread, pyqtSignal, QUrl
+from PyQt6.QtCore import (
+    Qt, QObject, QThread, pyqtSignal, QUrl, QAbstractTableModel, QModelIndex
+    )
 
 
 class Worker(QObject):
@@ -32,6 +34,8 @@ class Worker(QObject):
       exits safely
      to_log: a pyqtSignal(str) that is used to update the GUI's log
      to_table: a pyqtSignal(str) that is used to update the GUI's table
+     to_index: a pyqtSignal(object) that hands the csv_index.CsvIndex of the
+      input to the GUI's table
 
     Methods:
      run: will call main.main() and give all necessary parameters. also deals
@@ -43,6 +47,7 @@ class Worker(QObject):
     encountered_error = pyqtSignal()
     to_log = pyqtSignal(str)
     to_table = pyqtSignal(str)
+    to_index = pyqtSignal(object)
 
 
     def __init__(self, input_path, output_name, gotten_format):
@@ -53,8 +58,13 @@ class Worker(QObject):
 
 
     def run(self):
+        # the input is indexed here, off the GUI's thread, and the one index
+        #  is shared by the table and the scraping
+        index = csv_index.CsvIndex(self.input_path)
+        self.to_index.emit(index)
         result = main.main(self.input_path, self.output_name,
-                           self.gotten_format, self.to_log, self.to_table)
+                           self.gotten_format, self.to_log, self.to_table,
+                           people_index=index)
         # result will return nothing if main exits normally. False otherwise
         if result is None:
             self.finished.emit()
@@ -62,6 +72,89 @@ class Worker(QObject):
             self.encountered_error.emit()
 
 
+class PeopleTableModel(QAbstractTableModel):
+    """
+    The model behind the table tab. People are read from the input csv only
+    when the table needs to show them, by seeking straight to their row with
+    a csv_index.CsvIndex, so the table costs the same however big the input
+    is.
+
+    Attributes:
+     index: the CsvIndex of the input csv, or None before a run starts
+     completed: the set of rows that have been scraped and saved
+
+    Class variables:
+     header: the column names of the table
+     cache_size: how many recently shown rows are kept in memory
+
+    Methods:
+     set_index: points the table at a new input csv
+     mark_completed: marks some row as scraped
+     rowCount, columnCount, data, headerData: used by Qt to draw the table
+    """
+
+    header = ["Person", "Institution", "Completed?"]
+    cache_size = 500
+
+    def __init__(self):
+        super().__init__()
+        self.index = None
+        self.completed = set()
+        self.rows = {}
+
+
+    def set_index(self, index):
+        self.beginResetModel()
+        self.index = index
+        self.completed = set()
+        self.rows = {}
+        lowered = [h.lower() for h in index.header]
+        self.name_col = lowered.index("name")
+        self.institution_col = lowered.index("institution")
+        self.endResetModel()
+
+
+    def mark_completed(self, row):
+        self.completed.add(row)
+        cell = self.createIndex(row, 2)
+        self.dataChanged.emit(cell, cell)
+
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if self.index is None else len(self.index)
+
+
+    def columnCount(self, parent=QModelIndex()):
+        return len(self.header)
+
+
+    def person(self, row):
+        if row not in self.rows:
+            if len(self.rows) >= self.cache_size:
+                self.rows.clear()
+            fields = self.index.row(row)
+            fields = fields + [""] * (len(self.index.header) - len(fields))
+            self.rows[row] = (fields[self.name_col],
+                              fields[self.institution_col])
+        return self.rows[row]
+
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if role != Qt.ItemDataRole.DisplayRole or not index.isValid():
+            return None
+        if index.column() == 2:
+            return "Yes" if index.row() in self.completed else "No"
+        return self.person(index.row())[index.column()]
+
+
+    def headerData(self, section, orientation,
+                   role=Qt.ItemDataRole.DisplayRole):
+        if role == Qt.ItemDataRole.DisplayRole \
+           and orientation == Qt.Orientation.Horizontal:
+            return self.header[section]
+        return None
+
+
 class TopChunk(QWidget):
     """
     Initializes the top chunk of the GUI, above the tab chunk.
@@ -208,6 +301,7 @@ class TopChunk(QWidget):
         self.thread.finished.connect(self.thread.deleteLater)
         self.worker.to_log.connect(self.tab_chunk.add_log_text)
         self.worker.to_table.connect(self.tab_chunk.set_table_values)
+        self.worker.to_index.connect(self.tab_chunk.set_table_index)
         self.thread.start()
 
         # disables the process button until processing is complete
@@ -248,6 +342,7 @@ class TabChunk(QWidget):
      init_tabs: creates and calls functions for each tab
      init_table_tab: deals with creating the table
      set_table_values: called whenever the table needs to be updated
+     set_table_index: builds the table from the index of the input csv
      def_init_log_tab: creates the log
      add_log_text: adds text to the log. Text is formatted using basic HTML
      init_alteration_tab: builds the tab used to change and select the output
@@ -263,8 +358,8 @@ class TabChunk(QWidget):
      load_format: triggered when the drop down menu has a new option selected.
       it will take the user's choice, find the corresponding txt file, and
       load in the format into the alteration tab.
-     get_format: gets all the headers, prompts, and sites and returns them
-      as a dict
+     get_format: gets all the headers, prompts, and sites (plus the settings
+      of the loaded saved format) and returns them as a dict
      save_format: saves the current format using the selected name (chosen in
       a dialog box) in a text file in ./saved_output_formats/
      generate_prompts: this will automatically add prompts (overwritting any
@@ -285,6 +380,9 @@ class TabChunk(QWidget):
         super().__init__(parent)
 
         self.saved_output_format_names = {}
+        # the #SETTINGS of the loaded saved format. They have no widgets in the
+        #  alteration tab, so they are carried along as they are
+        self.loaded_settings = {}
         
         self.init_tabs()
         
@@ -306,15 +404,15 @@ class TabChunk(QWidget):
 
     def init_table_tab(self):
         """
-        Creates the basic layout of the table tab, using a QTableWidget object.
-        The table has three columns and will have a number of rows equal to the
-        amount of people being scraped. The table is centered through an
-        extremely hacky method, but so it goes.
+        Creates the basic layout of the table tab, using a QTableView object
+        backed by a PeopleTableModel. The table has three columns and will
+        have a number of rows equal to the amount of people being scraped.
+        The table is centered through an extremely hacky method, but so it
+        goes.
         """
-        self.table = QTableWidget()
-        self.table.setColumnCount(3)
-        header = ["Person", "Institution", "Completed?"]
-        self.table.setHorizontalHeaderLabels(header)
+        self.table_model = PeopleTableModel()
+        self.table = QTableView()
+        self.table.setModel(self.table_model)
 
         # centering the table using empty space
         layout = QHBoxLayout()
@@ -348,31 +446,27 @@ class TabChunk(QWidget):
          completed:ROW_NUM
         where ROW_NUM is the row number corresponding to the name/institution
         of the finished person.
-        Building the table is done via a string like
-         NAME1,INSTITUTION1*NAME2,INSTITUTION2
-        with each name/institution found in the input csv file.
+        The table is built by set_table_index() instead, so the string
+         index:PATH
+        that is sent once the input is indexed is ignored here.
 
         info: the string being analyzed
         """
 
-        if "completed" in info:
+        if info.startswith("completed:"):
             row = int(info.split(":")[-1])
-            curr_completed = self.table.setItem(row, 2, QTableWidgetItem("Yes"))
-        else:
-            # '*' is used as a splitter between each researcher being scraped
-            #  while ',' is used as a splitter between the name and the
-            #  institution.
-            people = [person.split(",") for person in info.split("*")]
-
-            # there will always be an empty array at the end 
-            del people[-1]
-
-            # fills the table
-            self.table.setRowCount(len(people))
-            for r in range(len(people)):
-                for c in range(len(people[r])):
-                    self.table.setItem(r, c, QTableWidgetItem(people[r][c]))
-                    self.table.setItem(r, 2, QTableWidgetItem("No"))
+            self.table_model.mark_completed(row)
+
+
+    def set_table_index(self, index):
+        """
+        Builds the table from the csv_index.CsvIndex of the input, which the
+        Worker made off the GUI's thread. The table only reads the rows it
+        is showing.
+        """
+        lowered = [h.lower() for h in index.header]
+        if "name" in lowered and "institution" in lowered:
+            self.table_model.set_index(index)
             
 
     def init_log_tab(self):
@@ -537,6 +631,7 @@ class TabChunk(QWidget):
         self.clear_layout(self.site_section)
 
         current_text = self.drop_down.currentText()
+        self.loaded_settings = {}
 
         # if the base option is selected on the drop down, then just build
         #  it basic and leave it 
@@ -566,6 +661,7 @@ class TabChunk(QWidget):
             return
 
         # all of the loaded format are added to the alteration tab
+        self.loaded_settings = saved['settings']
         for h in saved['headers']:
             current = self.add_new_column_box()
             current.setText(h)
@@ -594,7 +690,8 @@ class TabChunk(QWidget):
         #  output' will be filled
         formatting = {'headers': [],
                      'prompts': [],
-                     'sites': []}
+                     'sites': [],
+                     'settings': dict(self.loaded_settings)}
 
         # for each in the number of widgets in this section, get the text if
         #  the widget is a QLineEdit object
@@ -669,6 +766,7 @@ class TabChunk(QWidget):
             to_save = {'headers': header,
                        'prompts': prompts,
                        'sites': sites,
+                       'settings': self.loaded_settings,
                        'name': name}
             try:
                 output_format.save_format(to_save)
@@ -786,7 +884,10 @@ def show_error_to_user(message):
     dialog.setText(message)
     dialog.exec()
 
-app = QApplication([])
-window = UserInterface()
-window.show()
-app.exec()
+# the guard keeps the parse pool's processes, which import this module again
+#  when they start, from opening windows of their own
+if __name__ == "__main__":
+    app = QApplication([])
+    window = UserInterface()
+    window.show()
+    app.exec()
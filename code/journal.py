@@ -0,0 +1,156 @@
+from output_format import get_setting
+import disk_cache
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# the stages whose results are kept for each person, in pipeline order.
+#  Each is a column of the people table holding a JSON value.
+STAGES = ["links", "text_hashes", "emails", "gpt_output", "row"]
+
+# a run is forgotten once it finishes. One that never finished, and that
+#  nothing was recorded for in this many days, is forgotten as well
+MAX_AGE_DAYS = 30
+
+# the settings that change what a run writes, and so are part of its run_id().
+#  The others (workers, browsers, caches, resume, ...) only change how fast it
+#  gets there, so they can be changed before resuming a run
+OUTPUT_SETTINGS = ["search_url", "bad_link_prefixes", "bad_locations",
+                   "fuse_prompts", "fused_token_budget", "token_budget"]
+
+
+def run_id(input_path, output_format, output_name):
+    """
+    Identifies a run by its input file (path, size, and modification time),
+    the parts of its output format that change its output (the headers,
+    prompts, sites, and OUTPUT_SETTINGS), and its output path, so that
+    starting the same run again finds the journal of the first attempt.
+    """
+    stat = os.stat(input_path)
+    described = json.dumps([
+        os.path.abspath(input_path), stat.st_size, stat.st_mtime,
+        output_format.get('headers'), output_format.get('prompts'),
+        output_format.get('sites'),
+        {name: get_setting(output_format, name) for name in OUTPUT_SETTINGS},
+        os.path.abspath(output_name)
+    ], sort_keys=True)
+    return hashlib.sha256(described.encode("utf-8")).hexdigest()
+
+
+def text_hash(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+class RunJournal:
+    """
+    A SQLite record of what has been done for each person of a run, written
+    as each stage of the pipeline finishes for them. If the run dies, starting
+    it again skips everyone whose row was already written, and picks the
+    others up after the last stage they completed. Once the run finishes its
+    record is cleared, so starting it again scrapes everyone afresh, and the
+    records of runs left unfinished for MAX_AGE_DAYS are dropped.
+
+    Attributes:
+     run: the run_id() of the run being journaled
+     resumed: how many people had something in the journal when the run
+      started
+
+    Methods:
+     load: gets every recorded stage result for one person
+     record: saves the result of one stage for one person
+     clear: forgets everything about this run, or about some of its people
+     close: closes the database
+    """
+
+    def __init__(self, run):
+        os.makedirs(disk_cache.CACHE_FOLDER, exist_ok=True)
+        path = os.path.join(disk_cache.CACHE_FOLDER, "journal.sqlite")
+        self.run = run
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS people ("
+            " run TEXT NOT NULL,"
+            " idx INTEGER NOT NULL,"
+            + "".join(" " + stage + " TEXT," for stage in STAGES) +
+            " updated REAL,"
+            " PRIMARY KEY (run, idx))"
+        )
+        # journals made before the updated column existed get it added
+        columns = [row[1] for row
+                   in self.conn.execute("PRAGMA table_info(people)")]
+        if "updated" not in columns:
+            self.conn.execute("ALTER TABLE people ADD COLUMN updated REAL")
+        self.conn.execute(
+            "DELETE FROM people WHERE run IN (SELECT run FROM people"
+            " GROUP BY run HAVING MAX(COALESCE(updated, 0)) < ?)",
+            (time.time() - MAX_AGE_DAYS * 24 * 60 * 60,)
+        )
+        self.conn.commit()
+        self.resumed = self.conn.execute(
+            "SELECT COUNT(*) FROM people WHERE run = ?", (run,)
+        ).fetchone()[0]
+
+
+    def load(self, index):
+        """
+        return: a dict of stage name to the recorded result, containing only
+         the stages that were recorded for the person at index
+        """
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT " + ", ".join(STAGES) + " FROM people"
+                " WHERE run = ? AND idx = ?", (self.run, index)
+            ).fetchone()
+        if row is None:
+            return {}
+        return {stage: json.loads(value) for stage, value in zip(STAGES, row)
+                if value is not None}
+
+
+    def record(self, index, stage, value):
+        """
+        Saves value (anything JSON can hold) as the result of stage for the
+        person at index.
+        """
+        as_json = json.dumps(value, default=str)
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR IGNORE INTO people (run, idx) VALUES (?, ?)",
+                (self.run, index)
+            )
+            self.conn.execute(
+                "UPDATE people SET " + stage + " = ?, updated = ?"
+                " WHERE run = ? AND idx = ?",
+                (as_json, time.time(), self.run, index)
+            )
+            self.conn.commit()
+
+
+    def clear(self, start=None, end=None):
+        """
+        Forgets the people of this run, or only those from index start up to
+        (not including) end if they are given.
+        """
+        with self.lock:
+            if start is None:
+                self.conn.execute("DELETE FROM people WHERE run = ?",
+                                  (self.run,))
+            else:
+                self.conn.execute(
+                    "DELETE FROM people WHERE run = ? AND idx >= ?"
+                    " AND idx < ?", (self.run, start, end)
+                )
+            self.conn.commit()
+        if start is None:
+            self.resumed = 0
+
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
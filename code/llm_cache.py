@@ -0,0 +1,50 @@
+import disk_cache
+import hashlib
+import json
+
+
+class LlmCache:
+    """
+    A persistent memo of chat completions. The key is a hash of the model,
+    the system prompt (with the person's name and institution already filled
+    in), and the user content (the webtext), so any call that would be sent
+    to openai byte-for-byte the same as an earlier one is answered from disk
+    instead.
+
+    Attributes:
+     cache: the disk_cache.DiskCache holding the responses
+
+    Methods:
+     get: returns the stored response text for a call, or None
+     put: stores the response text of a call
+     stats: a short string for the log
+     close: closes the underlying cache
+    """
+
+    def __init__(self, max_bytes):
+        self.cache = disk_cache.DiskCache("llm", max_bytes=max_bytes,
+                                          compress=True)
+
+
+    def key(self, model, system, user):
+        as_json = json.dumps([model, system, user])
+        return hashlib.sha256(as_json.encode("utf-8")).hexdigest()
+
+
+    def get(self, model, system, user):
+        value = self.cache.get(self.key(model, system, user))
+        if value is None:
+            return None
+        return value.decode("utf-8")
+
+
+    def put(self, model, system, user, content):
+        self.cache.put(self.key(model, system, user), content.encode("utf-8"))
+
+
+    def stats(self):
+        return self.cache.stats()
+
+
+    def close(self):
+        self.cache.close()
@@ -1,106 +1,213 @@
 from user_agents import user_agents
-from openpyxl import Workbook, load_workbook
-from bs4 import BeautifulSoup
-import re
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit, parse_qs
+from output_format import get_setting, fuse_prompts
 import time
-import json
-import os
+import itertools
 import random
 import requests
-import csv
-import time
 import output_format
+import parse_pool
+import parsing
 import analysis
-
-
-bad_link_prefixes = ["/search", "q=", "/?",
-                     "/advanced_search"]
-
-bad_locations = ["facebook", "instagram",
-                 "linkedin", "twitter", "ratemyprofessors",
-                 "coursicle", "youtube", "amazon",
-                 ".doc", ".pdf", "wiki", "imgres"]
+import browser_pool
+import excel_writer
+import fetcher
+import journal
+import csv_index
+import disk_cache
+import page_cache
+import llm_cache
+import metrics
+import pipeline
+import rate_limit
+import url_registry
+import url_filter
+
+
+# the size of the queue in front of each stage of the scraping pipeline. The
+#  number of worker threads of the search, fetch, and llm stages are
+#  settings, while the email extraction is cheap enough for a single thread.
+#  The Excel writer at the end of the pipeline is always a single thread that
+#  writes people in input order.
+EXTRACT_WORKERS = 1
+STAGE_QUEUE_SIZE = 8
+
+# the size of the connection pool shared by every search request of a run
+SEARCH_POOL_SIZE = 16
 
 
 def build_output_file(file_path, header, log):
     """
-    This builds the sheet, adds the relevant column names,
-    then openpyxl.load_workbook() will be called to append
-    new researchers as they are scraped and processed.
+    This builds the sheet and adds the relevant column names. The
+    excel_writer.ExcelWriter that is returned keeps the workbook open so that
+    new researchers can be appended as they are scraped and processed.
 
     file_path: the path of the excel file that is to be built
     header: the header of the new file
     log: a pyqtSignal(str) that will cause the GUI to be updated if the build
      fails
     return:
-     True: if the build is good
+     an ExcelWriter: if the build is good
      False: if the build is not. This will trigger the process ending and
       an error dialog box being displayed
     """
 
-    wb = Workbook()
-    ws = wb.active
-    ws.append(header)
     # If the file cannot be built, that likely means that one of the same
     #  name exists elsewhere.
     try:
-        wb.save(file_path)
-        return True
+        writer = excel_writer.ExcelWriter(file_path, header)
     except PermissionError:
         log.emit("<br><br><b>AN ERROR WAS ENCOUNTERED WHEN ACCESSING THE" \
                  " OUTPUT EXCEL FILE. THIS LIKELY MEANS THAT IT IS OPEN" \
                  " SOMEWHERE. STOPING SCRAPING.</b>")
         return False
+    if writer.recovered is not None:
+        log.emit("<br><b>The rows of an earlier run that did not finish" \
+                 " were saved to " + writer.recovered + ".</b><br>")
+    return writer
 
 
-def read_csv(file_path, table, log):
+def read_csv(file_path, table, log, index=None):
     """
-    Reads the csv at file_path and loads each researcher as a dict into the
-    list to_search.
+    Indexes the csv at file_path, checking that it has the columns scraping
+    needs. Nothing but the byte offset of each row is kept; the people are
+    read one at a time by iter_people() as the pipeline asks for them, so
+    memory use does not grow with the size of the input.
 
     file_path: the path of the csv that was inputted by the user.
     table: a pyqtSignal(str) that updates the table tab
-    return: a list of dicts, where each dict contains
-     'headers': a list containing all strings in the header
+    index: the csv_index.CsvIndex of the file, if the caller already built
+     one, so the file is not read through twice
+    return: a csv_index.CsvIndex of the file, or False if there is nothing to
+     scrape
+    """
+
+    if index is None:
+        index = csv_index.CsvIndex(file_path)
+    header = [h.lower() for h in index.header]
+
+    # there must be categories for name and institution in the input
+    #  csv, otherwise the gui will show an error
+    if "name" not in header or "institution" not in header:
+        log.emit("<br><br> It looks like you did not include the" \
+                 " name and/or the institution in the input csv.<br> " \
+                 " Scraping is not possible without these, halting the" \
+                 " process.")
+        return False
+    if len(index) == 0:
+        return False
+
+    # the table reads the people it shows straight from the file, using
+    #  its own index of it
+    table.emit("index:" + file_path)
+    return index
+
+
+def iter_people(index, start=0):
+    """
+    A generator of the people in an indexed csv, read lazily from the file.
+
+    index: the csv_index.CsvIndex made by read_csv()
+    start: the row to start from
+    return: yields a dict for each person, containing
+     'data_from_csv': every column of the row, keyed by the lowercased
+      column name
      'name': the person's name
      'institution': the person's institution
-     plus any other column in the input csv
+     'index': the person's row in the csv, not counting the header
     """
 
-    to_search = []
-    for_table = ""
-    with open(file_path, 'r') as f:
-        reader = csv.reader(f)
-        header = next(reader)
+    header = [h.lower() for h in index.header]
+    for i, row in index.rows(start):
+        # short rows are padded, as a row missing the institution would
+        #  otherwise stop the whole run
+        row = row + [""] * (len(header) - len(row))
+        person_data = {'data_from_csv': {header[j] : row[j] \
+                          for j in range(0,len(header))},
+                       'index': i}
+        person_data['name'] = person_data['data_from_csv']['name']
+        person_data['institution'] = person_data['data_from_csv']['institution']
+        yield person_data
 
-        for person in reader:
-            person_data = {'data_from_csv': {header[i].lower() : person[i] \
-                              for i in range(0,len(header))}}
 
+def wants_emails(headers):
+    """
+    Whether the output has an email column, whose emails are then found with
+    regex instead of openai.
+    """
+    return any(email in headers
+               for email in ["email", "Email", "emails", "Emails"])
 
-            to_search.append(person_data)
 
-            # there must be categories for name and institution in the input
-            #  csv, otherwise the gui will show an error
-            try:
-                person_data['name'] = person_data['data_from_csv']['name']
-                person_data['institution'] = person_data['data_from_csv']['institution']
-            except KeyError:
-                log.emit("<br><br> It looks like you did not include the" \
-                         " name and/or the institution in the input csv.<br> " \
-                         " Scraping is not possible without these, halting the" \
-                         " process.")
-                return False
-    
-    # the for_table string is built in this way to make parsing done
-    #  for the table more easy.
-    for_table +=  person_data['name']+ "," \
-        + person_data['institution'] + "*"
-    table.emit(for_table)
-    return to_search
+def build_search_session():
+    """
+    Builds the requests.Session whose pooled connections are shared by every
+    search request in a run; it is safe to use from the pipeline's threads.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=SEARCH_POOL_SIZE,
+                          pool_maxsize=SEARCH_POOL_SIZE)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
 
+def normalize_query(search_url):
+    """
+    Builds the search cache key for a search URL: the host, plus the query
+    lowercased with its whitespace collapsed, so that the same name,
+    institution, and site term always give the same key.
+    """
+    parts = urlsplit(search_url)
+    query = " ".join(parse_qs(parts.query).get('q', [""])[0].lower().split())
+    return parts.netloc.lower() + "|" + query
 
-def get_links(person, sites, agent, log):
+
+def get_search_pages(all_search, agent, resources):
+    """
+    Sends every search query at once over the run's pooled session, with the
+    rate limiter deciding when each one is allowed to go out. Searches found
+    in the search cache are not sent at all.
+
+    all_search: the list of search URLs
+    agent: the user agent string the searches are sent with
+    resources: the dict built by start_resources()
+    return: the content of each search, in bytes, in the same order as
+     all_search
+    """
+    session = resources['session']
+    limiter = resources['limiter']
+    cache = resources['search cache']
+
+    run_metrics = resources.get('metrics')
+
+    def search(url):
+        if cache is not None:
+            key = normalize_query(url)
+            content = cache.get(key)
+            if content is not None:
+                return content
+        limiter.acquire(url)
+        with metrics.timed(run_metrics, "search_request"):
+            req = session.get(url, headers={'User-Agent': agent})
+        if run_metrics is not None:
+            run_metrics.count("search_bytes", len(req.content))
+            if req.status_code != 200:
+                run_metrics.count("search_bad_status")
+        # only good responses are kept, so that a block page or an error is
+        #  not served back on the next run
+        if cache is not None and req.status_code == 200:
+            cache.put(key, req.content)
+        return req.content
+
+    with ThreadPoolExecutor(max_workers=len(all_search)) as executor:
+        return list(executor.map(search, all_search))
+
+
+def get_links(person, sites, agent, log, resources, link_filter=None,
+              search_url=output_format.DEFAULT_SETTINGS['search_url']):
     """
     Gets relevant links from the first page of a google search for some person.
 
@@ -112,18 +219,22 @@ def get_links(person, sites, agent, log):
       'https://www.google.com/search?q=Santa Claus North Pole NORAD Tracks Santa'
       Could be queries used for the individual Santa Claus if the only useful
       site that was inputted was NORAD Tracks Santa.
-    agent: the agent used for searching
+    agent: the user agent string the searches are sent with
     log: a pyqtSignal(str) which emits useful information to the GUI log.
+    resources: the dict built by start_resources(), holding the session the
+     searches are sent over, the limiter that paces them, and the search cache
+    link_filter: the url_filter.UrlFilter that picks the good links, built
+     once per run by build_link_filter(). One using the default blocklists
+     and sites is built if it is not given
+    search_url: what the query is appended to, the search_url setting
     return: all appropriate links found for some individual. See comments for
      a definition of appropriate
     """
 
     query = person['name'] + " " + person['institution']
 
-    links = []
-
     # google's programmable search is used, to avoid getting locked out
-    search_url = f"https://www.google.com/search?q={query}"
+    search_url = search_url + query
     # creating a list of search terms to use
     all_search = [search_url + " " + site for site in sites]
     all_search = [search_url] + all_search
@@ -133,159 +244,93 @@ def get_links(person, sites, agent, log):
     to_log = [f"<a href=\"{site}\">{site}</a>" for site in all_search]
     log.emit("<br>".join(to_log) + "<br><br>")
 
-    # gets all the search content, in bytes
-    content = []
-    for search in all_search:
-        req = requests.get(search, agent)
-        time.sleep(0.5)
-        content.append(req.content)
-        
-    # BeautifulSoup is used to analyze all of the query results at once, and
-    #  pull anchor elements from the html
-    bs = BeautifulSoup(b''.join(content), 'html.parser')
-    raw_links = bs.select("a")
-    
-    raw_links = []
-    # filter links that do not contain "google.com" or start with the
-    #  prefixes defined in bad_link_prefixes
-    filtered_links = [link for link['href'] in raw_links
-                      if not any(link.startswith(prefix)
-                                 or link.find('google.com') > 0
-                                 for prefix in bad_link_prefixes)]
-
-    # filter links that don't contain searches
-    filtered_links = [link for link in filtered_links
-                      if not any(link.find(search) > -1
-                                 for search in bad_locations)]
-
-    # only grab the relevent part of the link if it includes more in it
-    links += [link.split("/url?q=")[-1].split("&sa")[0]
-              for link in filtered_links]
-    links = [link for link in links if "/search" not in link]
-
-    # finally, choosing good links based on our parameters:
+    # gets all the search content, in bytes. the searches are sent together
+    #  and paced by the limiter rather than by a fixed sleep
+    content = get_search_pages(all_search, agent, resources)
+
+    # only the anchor elements of each results page are parsed, in the parse
+    #  pool if there is one
+    if resources.get('parse pool') is not None:
+        anchors = resources['parse pool'].anchors(content)
+    else:
+        anchors = [parsing.anchors(page) for page in content]
+    raw_links = [href for page in anchors if not isinstance(page, Exception)
+                 for href, string in page
+                 if href is not None]
+
+    # the links are unwrapped from google's redirects and put in canonical
+    #  form, any that are google's own, start with one of the bad link
+    #  prefixes, or contain one of the bad locations are dropped, and then
+    #  good links are chosen based on our parameters:
     #  if any of the user-specified good sites are present in the link
     #  if the person's first and last name are present in the link
     #  if the person's institution is present in the link
     # This logic is heavily dependent on the quality of google's search
     #  algorithm, there are obviously a lot of holes and chances for bad data
     #  to slip in
-    full_name = person['name'].lower().split(" ")
-    first_name = full_name[0]
-    last_name = full_name[-1]
-    institution = person['institution']
-    # if the users specify researchgate, then a check to see if the person's
-    #  name as well as researchgate is used instead
-    if "researchgate" in sites:
-        del sites[sites.index("researchgate")]
-    links = [link for link in map(lambda x: x.lower(), set(links))
-             if any(element in link for element in sites)
-             or (first_name in link and last_name in link)
-             or institution.lower() in link
-             or ("researchgate" in link
-                 and first_name in link
-                 and last_name in link)]
-    return links
-
-
-def write_to_excel(output_path, person, log):
+    if link_filter is None:
+        link_filter = url_filter.UrlFilter(sites)
+    return link_filter.filter(raw_links, person)
+
+
+def build_link_filter(output_format):
+    """
+    Builds the url_filter.UrlFilter used for every person in a run, from the
+    format's useful sites and its bad_link_prefixes and bad_locations
+    settings.
+    """
+    def split(name):
+        return [item.strip() for item
+                in get_setting(output_format, name).split(",")
+                if item.strip()]
+
+    return url_filter.UrlFilter(output_format['sites'],
+                                split('bad_link_prefixes'),
+                                split('bad_locations'))
+
+
+def write_to_excel(writer, person, log, formatter=None):
     """
     Writes each person to excel by using the package openpyxl.
 
-    How it works is it checks the pre-written Excel sheet for header names (see
-    build_output_file() and finds the corresponding key in the person dict
-    that is passed to this funciton. The value for that key is then put into
-    a list of length equal to the number of needed columns at the index corresponding
-    to the column with the same name. After all of the keys and columns are matched
-    up, the list is appended to the workbook and the workbook is closed.
+    How it works is a excel_writer.RowFormatter, compiled from the header
+    names of the sheet (see build_output_file()), finds the column of each
+    key in the output of the person dict that is passed to this funciton. The
+    value for that key is then put into a list of length equal to the number
+    of needed columns at the index of that column. After all of the keys and
+    columns are matched up, the list is appended to the workbook, which the
+    writer saves to disk every few rows.
 
     In this way, only needed columns are saved, and the workbook is updated
-    after each person is scraped.
+    as people are scraped.
 
-    output_path: the path of the Excel file to write to
+    writer: the excel_writer.ExcelWriter made by build_output_file()
     person: a dict containing all relevant and scraped information on one
-     person
+     person. If it already has a 'row' (a person resumed from the run
+     journal), that row is written as it is. Otherwise the row is built by
+     formatter and saved into person['row'].
     log: a pyqtSygnal(str) object that is used to update the GUI's log
      with pertinent information
+    formatter: the RowFormatter for writer's header. Callers writing many
+     rows should build it once and pass it in; otherwise one is built here
     """
 
-    wb = load_workbook(output_path, data_only=True)
-    ws = wb.active
-    # getting the column names. this is a list of cells, not of strings 
-    header = ws[1]
-        
-    # if there was no relevent data found for some person, then 'NONE'
-    #  is written into the Excel cell.
-    to_write = [""]*len(header)
-
-    # outer loop cycles through the keys in the person's output. keys are
-    #  checked to see if they exist as headers in the output and if they are
-    #  then the value corresponding to that key is saved into the appropriate
-    #  index in to_write
-    for key in person['output']:
-
-        # formatting data for one of the reserved headers
-        if key == "other key notes":
-            patents = "0"
-            awards = ""
-            if "patents under their name" in person['output']:
-                patents = person['output']['patents under their name']
-                patents = re.split(",|\n", patents)
-                patents.remove("")
-                patents = str(len(patents))
-            if "awards recieved" in person['output']:
-                awards = person['output']['awards recieved']
-                awards = re.split(",|\n", awards)
-                awards.remove("")
-                awards = "\n" + "\n".join(awards)
-
-            full_string = f"Patents found: {patents} \n\n" \
-                f"Awards recieved found: {awards}"
-            person['output'][key] = full_string
-
-        # the inner loop cycles through each header object from the Excel sheet,
-        #  if a match is found between the strings of key and h.internal_value,
-        #  then the output is saved in that header's corresponding index on
-        #  to_write
-        for h in header:
-            # gets the column integer of this header cell
-            col = h.column
-
-            # 'relevant links' is a reserved column; this will have the links
-            #  found during scraping placed into it.
-            if h.internal_value.lower() == "relevant links":
-                to_write[col - 1] = "\n".join(person['links used'])
-                continue 
-            elif h.internal_value.lower() == "other key notes":
-                # no additional formatting needs to be done
-                to_write[col - 1] = person['output']['other key notes']
-                continue
-
-            data = person['output'][key]
-            # splitting the data string like this, then removing each first
-            #  blank string item is done for formatting purposes.
-            items = data.split("\n")
-            while len(items) > 0 and items[0] == "":
-                del items[0]
-
-            # using a set here is done to try and eliminate any repetition of
-            #  information
-            unique = "\n".join(set(items))
-
-            if h.internal_value.lower() == key.lower():
-                data = person['output'][key]
-
-                # minus one because the Excel row number is included in the
-                #  header cell list
-                to_write[col - 1] = unique 
-    
-    # appending the updated list to the worksheet object, and then using
-    #  a try-block to catch any writing errors
-    ws.append(to_write)
+    if 'row' not in person:
+        if formatter is None:
+            formatter = excel_writer.RowFormatter(writer.header)
+        person['row'] = formatter.format(person)
+    to_write = person['row']
+
+    # appending the updated list to the worksheet, and then using a try-block
+    #  to catch any writing errors if the writer saves this batch of rows
     try:
-        wb.save(output_path)
-        log.emit("<br><br><b>Saved the results for " + person['name'] + \
+        saved_before = writer.saved_rows
+        writer.append(to_write)
+        log.emit("<br><br><b>Added the results for " + person['name'] + \
                  " to Excel output.</b><br>")
+        if writer.saved_rows != saved_before:
+            log.emit("<b>Saved " + str(writer.saved_rows) + " rows to" \
+                     " disk.</b><br>")
         return True
     except PermissionError:
         log.emit("<br><br><b>An error was encountered when accessing the" \
@@ -294,7 +339,350 @@ def write_to_excel(output_path, person, log):
         return False
 
 
-def main(input_path, output_name, output_format, log, table):
+def start_resources(output_format, log):
+    """
+    Starts everything that is shared by every person in a run.
+
+    return: a dict containing
+     'metrics': the metrics.Metrics of the run
+     'pool': the browser_pool.BrowserPool used to render webpages
+     'fetcher': what analysis.get_pages() fetches pages with. Either the
+      fetcher.TieredFetcher in front of the pool, or the pool itself if the
+      format turns http_first off
+     'url registry': the url_registry.UrlRegistry of the pages fetched so far
+      in the run
+     'parse pool': the parse_pool.ParsePool that pages are parsed in, or None
+      if the format turns it off
+     'session': the pooled requests.Session used for searches
+     'limiter': the rate_limit.HostRateLimiter pacing the searches
+     'search cache': the disk_cache.DiskCache of search results, or None if
+      the format turns it off
+     'page cache': the page_cache.PageCache of rendered pages, or None if
+      the format turns it off
+     'llm cache': the llm_cache.LlmCache of openai responses, or None if
+      the format turns it off
+    """
+
+    resources = {}
+
+    # the timings and counters of the run, see metrics.py
+    resources['metrics'] = metrics.Metrics()
+    metrics_port = get_setting(output_format, 'metrics_port')
+    if metrics_port > 0:
+        try:
+            resources['metrics'].serve(metrics_port)
+            log.emit("Serving metrics at http://127.0.0.1:" + \
+                     str(metrics_port) + "/metrics<br>")
+        except OSError as e:
+            log.emit("Metrics could not be served on port " + \
+                     str(metrics_port) + ": " + str(e) + "<br>")
+
+    # the searches of every person share one connection pool, and one rate
+    #  limit per host, which the saved format can tune in its #SETTINGS
+    resources['session'] = build_search_session()
+    resources['limiter'] = rate_limit.HostRateLimiter(
+        get_setting(output_format, 'search_rate'),
+        get_setting(output_format, 'search_burst')
+    )
+
+    resources['search cache'] = None
+    if get_setting(output_format, 'search_cache'):
+        resources['search cache'] = disk_cache.DiskCache(
+            "search",
+            ttl=get_setting(output_format, 'search_cache_days') * 86400,
+            max_bytes=get_setting(output_format, 'search_cache_mb') \
+                * 1024 * 1024
+        )
+
+    resources['page cache'] = None
+    if get_setting(output_format, 'page_cache'):
+        resources['page cache'] = page_cache.PageCache(
+            get_setting(output_format, 'page_cache_days') * 86400,
+            get_setting(output_format, 'page_cache_mb') * 1024 * 1024
+        )
+
+    resources['llm cache'] = None
+    if get_setting(output_format, 'llm_cache'):
+        resources['llm cache'] = llm_cache.LlmCache(
+            get_setting(output_format, 'llm_cache_mb') * 1024 * 1024
+        )
+
+    # the warm chromium browsers used by analysis.get_pages()
+    extra_hosts = [host.strip() for host
+                   in get_setting(output_format, 'blocked_hosts').split(",")
+                   if host.strip()]
+    resources['pool'] = browser_pool.BrowserPool(
+        browser_count=get_setting(output_format, 'browsers'),
+        block_resources=get_setting(output_format, 'block_resources'),
+        blocked_hosts=browser_pool.BLOCKED_HOSTS + extra_hosts,
+        settle_time=get_setting(output_format, 'settle_ms'),
+        run_metrics=resources['metrics']
+    )
+    log.emit("Started " + str(resources['pool'].browser_count) + \
+             " browsers for rendering webpages.<br>")
+
+    resources['parse pool'] = None
+    parse_processes = get_setting(output_format, 'parse_processes')
+    if parse_processes != 0:
+        resources['parse pool'] = parse_pool.ParsePool(
+            None if parse_processes < 0 else parse_processes
+        )
+        log.emit("Started " + str(resources['parse pool'].size) + \
+                 " processes for parsing webpages.<br>")
+
+    # people who turn up the same pages share a single fetch of each. The
+    #  anchors of the pages are only worked out if emails are looked for
+    resources['url registry'] = url_registry.UrlRegistry(
+        keep_anchors=wants_emails(output_format['headers'])
+    )
+
+    resources['fetcher'] = resources['pool']
+    if get_setting(output_format, 'http_first'):
+        resources['fetcher'] = fetcher.TieredFetcher(
+            resources['pool'], run_metrics=resources['metrics']
+        )
+    return resources
+
+
+def stop_resources(resources, log):
+    """
+    Shuts down everything started by start_resources(), and logs how well
+    the fetching and the caches did. Their totals are also saved into the
+    run's metrics, which are left for the caller to save with
+    save_metrics().
+    """
+    record_totals(resources)
+    resources['metrics'].close()
+
+    log.emit("<br><b>Pages:</b> " + resources['url registry'].stats() + \
+             "<br>")
+    if resources['fetcher'] is not resources['pool']:
+        log.emit("<b>Fetching:</b> " + resources['fetcher'].stats() + "<br>")
+        resources['fetcher'].close()
+    log.emit("<b>Browsers:</b> " + resources['pool'].stats() + "<br>")
+    resources['pool'].close()
+    resources['session'].close()
+    if resources['parse pool'] is not None:
+        resources['parse pool'].close()
+    if resources['search cache'] is not None:
+        log.emit("<b>Search cache:</b> " + \
+                 resources['search cache'].stats() + "<br>")
+        resources['search cache'].close()
+    if resources['page cache'] is not None:
+        log.emit("<b>Page cache:</b> " + resources['page cache'].stats() + \
+                 "<br>")
+        resources['page cache'].close()
+    if resources['llm cache'] is not None:
+        log.emit("<b>GPT response cache:</b> " + \
+                 resources['llm cache'].stats() + "<br>")
+        resources['llm cache'].close()
+
+
+def record_totals(resources):
+    """
+    Copies the totals kept by the shared resources (fetch tiers, blocked
+    requests, cache hits) into the run's metrics as counters.
+    """
+    run_metrics = resources['metrics']
+    registry = resources['url registry']
+    run_metrics.set("pages_needed", registry.requested)
+    run_metrics.set("pages_fetched", registry.fetched)
+
+    pool = resources['pool']
+    run_metrics.set("blocked_requests", sum(pool.blocked.values()))
+    run_metrics.set("blocked_bytes_estimate", pool.blocked_bytes)
+    run_metrics.set("settle_timeouts", pool.settle_timeouts)
+    if resources['fetcher'] is not pool:
+        run_metrics.set("http_pages", resources['fetcher'].http_pages)
+        run_metrics.set("browser_pages", resources['fetcher'].browser_pages)
+        run_metrics.set("escalated_pages", resources['fetcher'].escalated)
+
+    caches = {'search_cache': resources['search cache']}
+    if resources['page cache'] is not None:
+        caches['page_cache'] = resources['page cache'].cache
+    if resources['llm cache'] is not None:
+        caches['llm_cache'] = resources['llm cache'].cache
+    for name, cache in caches.items():
+        if cache is not None:
+            run_metrics.set(name + "_hits", cache.hits)
+            run_metrics.set(name + "_misses", cache.misses)
+
+
+def save_metrics(run_metrics, output_name, log):
+    """
+    Saves the run's metrics next to the output, as <output>.metrics.json.
+    """
+    path = output_name + ".metrics.json"
+    try:
+        run_metrics.write_json(path)
+        log.emit("<br>Timings and counters were saved to " + path + "<br>")
+    except OSError as e:
+        log.emit("<br>The metrics could not be saved to " + path + ": " + \
+                 str(e) + "<br>")
+
+
+def build_pipeline(writer, output_format, client, get_email, resources,
+                   run_journal, log, table):
+    """
+    Builds the staged pipeline that main() runs every person through:
+     search: get_links() finds the person's links
+     fetch: the links are fetched by the fetcher, unless they are in the
+      page cache or another person already fetched them
+     extract: emails are pulled from the pages, if they are needed
+     llm: gpt analyzes the pages, and everything is combined into the output
+     write: a single writer saves each person to Excel, in input order
+    Each stage has its own bounded queue and its own number of workers (the
+    *_workers settings), so that the searching, rendering, and openai calls of
+    different people overlap instead of adding up.
+
+    Every stage records its result for a person in run_journal (a
+    journal.RunJournal). A stage whose result is already in the journal, from
+    an earlier attempt at the same run, is skipped and the recorded result is
+    used instead.
+
+    return: a pipeline.Pipeline object, ready to be run on the people
+    """
+
+    prompts = output_format['prompts']
+    headers = output_format['headers']
+    skip_gpt = prompts[0] == "NONE"
+
+    # unless the format turns it off, every page gets a single request that
+    #  asks for all of the columns at once
+    fused_prompt = None
+    if get_setting(output_format, 'fuse_prompts'):
+        fused_prompt = fuse_prompts(prompts)
+    fused_budget = get_setting(output_format, 'fused_token_budget')
+    token_budget = get_setting(output_format, 'token_budget')
+    fetch_concurrency = get_setting(output_format, 'fetch_concurrency')
+    link_filter = build_link_filter(output_format)
+    search_url = get_setting(output_format, 'search_url')
+    run_metrics = resources['metrics']
+
+    def search(person):
+        # time per person being scraped is displayed
+        person['start time'] = time.time()
+
+        # anything already done for this person in an earlier attempt
+        person['recorded'] = run_journal.load(person['index'])
+        if 'links' in person['recorded']:
+            person['links used'] = person['recorded']['links']
+            if 'row' in person['recorded']:
+                person['row'] = person['recorded']['row']
+            return person
+
+        # the agent used for requests from the web
+        agent = random.choice(user_agents)
+
+        # good links found by get_links are added to each person dict
+        #  google's programmable search is used to search google
+        person['links used'] = get_links(
+            person, output_format['sites'], agent, log, resources, link_filter,
+            search_url
+        )
+        run_journal.record(person['index'], 'links', person['links used'])
+
+        # the log will update with any good links found, if any
+        log.emit("<br><h3>Searched for " + person['name'] + ", " + \
+                 person["institution"] + "</h3><b>Sites found: ")
+        if len(person['links used']) == 0:
+            log.emit("N/A</b><br>")
+        else:
+            log.emit(str(len(person['links used'])) + "</b><br>")
+            log.emit("<br>".join([f"<a href=\"{site}\">{site}</a>" \
+                                  for site in person["links used"]]))
+        return person
+
+    def fetch(person):
+        recorded = person['recorded']
+        # the pages are only needed by the stages that have not been done yet
+        if 'row' in recorded or \
+           (skip_gpt or 'gpt_output' in recorded) and \
+           (not get_email or 'emails' in recorded):
+            return person
+        analysis.fetch_webtexts(person, resources, log, fetch_concurrency)
+        run_journal.record(person['index'], 'text_hashes',
+                           [journal.text_hash(webtext)
+                            for webtext in person['webtexts']])
+        return person
+
+    def extract(person):
+        recorded = person['recorded']
+        if not get_email or 'row' in recorded:
+            return person
+        if 'emails' in recorded:
+            person['emails'] = recorded['emails']
+        else:
+            with run_metrics.time("email"):
+                analysis.extract_emails(person, resources['parse pool'])
+            run_journal.record(person['index'], 'emails', person['emails'])
+        return person
+
+    def llm(person):
+        recorded = person['recorded']
+        if 'row' in recorded:
+            return person
+        if not skip_gpt:
+            if 'gpt_output' in recorded:
+                person['gpt output'] = recorded['gpt_output']
+            else:
+                analysis.analyze_webtexts(person, client, prompts, log,
+                                          resources['llm cache'],
+                                          fused_prompt, fused_budget,
+                                          token_budget, run_metrics)
+                run_journal.record(person['index'], 'gpt_output',
+                                   person['gpt output'])
+        # this gets all relevant found information for one person
+        person['output'] = analysis.build_output(person, headers)
+        # the pages and their texts are not needed anymore, and can be large
+        person.pop('pages', None)
+        person.pop('webtexts', None)
+        return person
+
+    # matches output keys to Excel columns, compiled once for the whole run
+    formatter = excel_writer.RowFormatter(writer.header)
+
+    def write(count, person):
+        # writes the found information to excel. the bool returned is
+        #  exactly like that from build_output_file
+        with run_metrics.time("excel_write"):
+            build_good = write_to_excel(writer, person, log, formatter)
+        if not build_good:
+            return False
+        if 'row' not in person['recorded']:
+            run_journal.record(person['index'], 'row', person['row'])
+
+        # outputting final tidbits of information
+        end = time.time()
+        run_metrics.observe("person", end - person['start time'])
+        run_metrics.count("people")
+        log.emit("<b>Time spent on " + person['name'] + ": " + \
+                 str(round(end - person['start time'], 2)) + " s</b>")
+        table.emit("completed:" + str(count))
+        return True
+
+    def timed_stage(name, func):
+        # every stage is timed per person, under stage_<name>
+        def run_stage(person):
+            with run_metrics.time("stage_" + name):
+                return func(person)
+        return run_stage
+
+    workers = {'search': get_setting(output_format, 'search_workers'),
+               'fetch': get_setting(output_format, 'fetch_workers'),
+               'extract': EXTRACT_WORKERS,
+               'llm': get_setting(output_format, 'llm_workers')}
+    stages = [pipeline.Stage(name, timed_stage(name, func),
+                             max(1, workers[name]), STAGE_QUEUE_SIZE)
+              for name, func in [('search', search),
+                                 ('fetch', fetch),
+                                 ('extract', extract),
+                                 ('llm', llm)]]
+    return pipeline.Pipeline(stages, write)
+
+
+def main(input_path, output_name, output_format, log, table, limit=None,
+         people_index=None):
     """
     For some csv formatted correctly (ie has a header and is filled with
     researchers, their institutions, and their domains) this will get
@@ -306,11 +694,12 @@ def main(input_path, output_name, output_format, log, table):
       institution: ...,
       any other elements included in the csv file: ...,
       links used: all the good links found by get_links(),
-      output: the output created by analysis.analyze(), as a sub-dict.
+      output: the output created by analysis.build_output(), as a sub-dict.
         Note that the links used are also within this sub-dict.
 
-    A loop will collect all of this information for each person; at the end
-    of each loop, the Excel file will be updated for the new person. Updating
+    A pipeline (see build_pipeline()) will collect all of this information,
+    with many people being worked on at once; the Excel file is updated for
+    each person, in input order, as soon as they are done. Updating
     continuously allows for data to be saved in case of any issues.
     
     input_path: the path to the input csv, gotten by interacting with the GUI
@@ -318,21 +707,26 @@ def main(input_path, output_name, output_format, log, table):
      there is already an Excel file with that path, it will be overwritten.
     log: a pyqtSignal(str) object that is used to update the GUI's log.
     table: a pyqtSignal(str) object that is used to update the GUI's table.
+     Anything else with an emit(str) method works too; see cli.py
+    limit: if given, only the first limit people of the input are scraped
+    people_index: the csv_index.CsvIndex of input_path, if the caller already
+     built one (the GUI shares its index with the table)
     """
 
-    # gets a list of dicts built using the input path. If name/institution is
-    #  not included in the input file, then scraping will be halted
-    to_search = read_csv(input_path, table, log)
-    if not to_search:
+    # indexes the input file, whose people are read lazily as they are
+    #  needed. If name/institution is not included in the input file, then
+    #  scraping will be halted
+    people_index = read_csv(input_path, table, log, people_index)
+    if not people_index:
         return False
 
     # the below chunk updates the log with initial data: how many individuals,
     #  the output header to be used, the prompts to be used, and the sites
     #  identified by the user as good
     sing_or_plur = " individuals"
-    if len(to_search) <= 1:
+    if len(people_index) <= 1:
         sing_or_plur = " individual"
-    log.emit("<h2>Starting scraping on " + str(len(to_search)) + \
+    log.emit("<h2>Starting scraping on " + str(len(people_index)) + \
              sing_or_plur + ".</h2><br><br><b>OUTPUT HEADER:</b><br>" + \
              ", ".join(output_format['headers']) + "<br>")
     for i in range(len(output_format['prompts'])):
@@ -342,11 +736,11 @@ def main(input_path, output_name, output_format, log, table):
         log.emit("<br><b>ADDITIONAL SEARCH TERMS:</b><br>" + \
                  ", ".join(output_format['sites']) + "<br>")
 
-    # attempts to build the Excel output file. build_good is a bool to show if
-    #  the sheet was accessed okay: True if there where no issues and False if
-    #  so. If False, then scraping will stop and the user will be notified
-    build_good = build_output_file(output_name, output_format['headers'], log)
-    if not build_good:
+    # attempts to build the Excel output file. writer is the ExcelWriter that
+    #  rows are added with if the sheet was accessed okay, and False if not.
+    #  If False, then scraping will stop and the user will be notified
+    writer = build_output_file(output_name, output_format['headers'], log)
+    if not writer:
         return False
 
     # an instance of an OpenAI() object
@@ -355,60 +749,60 @@ def main(input_path, output_name, output_format, log, table):
 
     # if the user wants emails to be found, then regex is used instead of
     #  openai. This bool ensures that happens
-    get_email = False
-    if "email" in output_format['headers'] \
-       or "Email" in output_format['headers'] \
-       or "emails" in output_format['headers'] \
-       or "Emails" in output_format['headers']:
+    get_email = wants_emails(output_format['headers'])
+    if get_email:
         log.emit("Regex will be used to scrape emails.<br>")
-        get_email = True
 
-    # this count is used to update the table in the GUI
-    count = 0
+    # the browsers, connection pools, and caches shared by every person in
+    #  the run. They are always shut down before main() returns, even if
+    #  scraping stops early
+    resources = start_resources(output_format, log)
+
     # the total time taken is displayed at the end
     total_time_start = time.time()
-    for person in to_search:
-        # time per person being scraped is displayed
-        start = time.time()
-    
-        log.emit("<br><h3>Scraping " + person['name'] + ", " + \
-                 person["institution"] + "</h3><br><br>")
-
-        # the agent used for requests from the web
-        agent = random.choice(user_agents)
-
-        # good links found by get_links are added to each person dict
-        #  google's programmable search is used to search google
-        person['links used'] = get_links(
-            person, output_format['sites'], agent, log
-        )
-
-        # the log will update with any good links found, if any
-        log.emit("<b>Sites found: ")
-        if len(person['links used']) == 0:
-            log.emit("N/A</b><br>")
-        else:
-            log.emit(str(len(person['links used'])) + "</b><br>")
-            log.emit("<br>".join([f"<a href=\"{site}\">{site}</a>" \
-                                  for site in person["links used"]]))
-
-        # this gets all relevant found information for one person
-        person['output'] = analysis.analyze(
-            person, client, output_format['prompts'], output_format['headers'],
-            get_email, log
-        )
-
-        # writes the found information to excel. the bool of build_good is
-        #  exactly like that from build_output_file
-        build_good = write_to_excel(output_name, person, log)
-        if not build_good:
-            return False
-
-        # outputting final tidbits of information
-        end = time.time()
-        log.emit("<b>Time spent: " + str(round(end - start, 2)) + " s</b>")
-        table.emit("completed:" + str(count))
-        count += 1
+    # the journal of this run. If the same input, format, and output were
+    #  started before and did not finish, everyone already done is skipped
+    run_journal = journal.RunJournal(
+        journal.run_id(input_path, output_format, output_name)
+    )
+    if not get_setting(output_format, 'resume'):
+        run_journal.clear()
+    elif run_journal.resumed > 0:
+        log.emit("<br><b>Resuming an earlier run: " + \
+                 str(run_journal.resumed) + " people were already started" \
+                 " or finished.</b><br>")
+
+    scraper = build_pipeline(writer, output_format, client, get_email,
+                             resources, run_journal, log, table)
+    finished = False
+    try:
+        people = iter_people(people_index)
+        if limit is not None:
+            people = itertools.islice(people, limit)
+        finished = scraper.run(people)
+    finally:
+        stop_resources(resources, log)
+        save_metrics(resources['metrics'], output_name, log)
+        # whatever rows were added are saved, even if scraping stopped early
+        try:
+            writer.close()
+        except PermissionError:
+            log.emit("<br><br><b>An error was encountered when accessing the" \
+                     " output Excel file. This likely means that it is open" \
+                     " somewhere.</b>")
+            finished = False
+        # a run that finished, with its rows saved, is not resumed; starting
+        #  it again scrapes everyone afresh
+        if finished:
+            run_journal.clear()
+        run_journal.close()
+
+    if scraper.error is not None:
+        stage_name, err = scraper.error
+        log.emit("<br><br><b>An error was encountered in the " + stage_name + \
+                 " stage, stopping scraping:</b><br>" + str(err))
+    if not finished:
+        return False
 
     # outputting the total time taken, in minutes
     total_time_end = time.time()
@@ -0,0 +1,269 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import random
+import re
+import threading
+import time
+
+# the quantiles reported for every timer
+QUANTILES = [0.5, 0.9, 0.99]
+
+# how many durations each timer keeps for working out its quantiles. Past
+#  this, a random sample of them is kept, so a long run's memory and the cost
+#  of a summary stay the same
+RESERVOIR_SIZE = 1000
+
+# every metric name is prefixed with this in the Prometheus text
+PROMETHEUS_PREFIX = "scraper_"
+
+
+def quantile(ordered, q):
+    """
+    The q quantile of a sorted list, by linear interpolation between the two
+    closest samples.
+    """
+    if not ordered:
+        return 0.0
+    position = q * (len(ordered) - 1)
+    low = int(position)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (position - low)
+
+
+class _Samples:
+    """
+    The durations given to one timer: their count, total, and max, and a
+    uniform random sample of at most size of them (reservoir sampling), which
+    the quantiles are worked out from.
+    """
+
+    def __init__(self, size, rng):
+        self.size = size
+        self.rng = rng
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.kept = []
+
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        if len(self.kept) < self.size:
+            self.kept.append(seconds)
+        else:
+            # every duration so far has the same chance of being kept
+            slot = self.rng.randrange(self.count)
+            if slot < self.size:
+                self.kept[slot] = seconds
+
+
+class _Timer:
+    """
+    The context manager given by Metrics.time().
+    """
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.observe(self.name, time.perf_counter() - self.start)
+        if exc_type is not None:
+            self.metrics.count(self.name + "_errors")
+        return False
+
+
+class Metrics:
+    """
+    Timers and counters for one run, shared by every thread of it. Timers
+    keep the count, total, and max of the durations they are given, and a
+    random sample of up to reservoir_size of them that their percentiles are
+    worked out from; counters are plain running totals.
+
+    The timers a run records are (all in seconds):
+     search_request: one search sent to google
+     page_render: one page rendered by the browser pool
+     http_fetch: one page fetched over plain HTTP
+     parse: parsing the newly fetched pages of one person
+     email: finding the emails of one person
+     llm_call: one openai request
+     excel_write: writing one row to the output
+     stage_<name>: one person going through a pipeline stage
+     person: one person, from the start of their search to their row
+    A timer whose block raised also counts <timer>_errors.
+    The counters include the bytes searched and fetched, the openai tokens
+    used, the pages fetched and shared, blocked requests, cache hits and
+    misses, and errors.
+
+    Attributes:
+     started: when the metrics were made (time.time())
+     reservoir_size: the most durations each timer keeps
+
+    Methods:
+     time: a context manager that times its block into a timer
+     observe: adds a duration to a timer
+     count: adds to a counter
+     set: sets a counter to a value
+     summary: everything recorded so far, as a dict
+     write_json: saves summary() to a file
+     prometheus: everything recorded so far, in Prometheus' text format
+     serve: serves prometheus() over HTTP until close() is called
+     close: stops serving
+    """
+
+    def __init__(self, reservoir_size=RESERVOIR_SIZE):
+        self.started = time.time()
+        self.reservoir_size = reservoir_size
+        self.rng = random.Random()
+        self.lock = threading.Lock()
+        self.timers = {}
+        self.counters = {}
+        self.server = None
+
+
+    def time(self, name):
+        return _Timer(self, name)
+
+
+    def observe(self, name, seconds):
+        with self.lock:
+            samples = self.timers.get(name)
+            if samples is None:
+                samples = _Samples(self.reservoir_size, self.rng)
+                self.timers[name] = samples
+            samples.add(seconds)
+
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+
+    def set(self, name, value):
+        with self.lock:
+            self.counters[name] = value
+
+
+    def summary(self):
+        """
+        return: a dict containing
+         'seconds': how long the run has been going
+         'timers': a dict of timer name to its count, total, mean, max, and
+          quantiles (as p50, p90, ..., from the timer's sample)
+         'counters': a dict of counter name to its value
+        """
+        with self.lock:
+            timers = {name: (samples.count, samples.total, samples.max,
+                             list(samples.kept))
+                      for name, samples in self.timers.items()}
+            counters = dict(self.counters)
+
+        summarized = {}
+        for name, (count, total, longest, kept) in sorted(timers.items()):
+            ordered = sorted(kept)
+            summarized[name] = {'count': count,
+                                'total': round(total, 4),
+                                'mean': round(total / count, 4),
+                                'max': round(longest, 4)}
+            for q in QUANTILES:
+                summarized[name]["p" + str(round(q * 100))] = \
+                    round(quantile(ordered, q), 4)
+        return {'seconds': round(time.time() - self.started, 2),
+                'timers': summarized,
+                'counters': dict(sorted(counters.items()))}
+
+
+    def write_json(self, path):
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=2)
+
+
+    def prometheus(self):
+        """
+        Timers become summaries (with a quantile label, _sum, and _count)
+        and counters become counters.
+        """
+        summary = self.summary()
+        lines = []
+        for name, timer in summary['timers'].items():
+            metric = PROMETHEUS_PREFIX + _metric_name(name) + "_seconds"
+            lines.append("# TYPE " + metric + " summary")
+            for q in QUANTILES:
+                lines.append(metric + '{quantile="' + str(q) + '"} ' +
+                             str(timer["p" + str(round(q * 100))]))
+            lines.append(metric + "_sum " + str(timer['total']))
+            lines.append(metric + "_count " + str(timer['count']))
+        for name, value in summary['counters'].items():
+            metric = PROMETHEUS_PREFIX + _metric_name(name) + "_total"
+            lines.append("# TYPE " + metric + " counter")
+            lines.append(metric + " " + str(value))
+        return "\n".join(lines) + "\n"
+
+
+    def serve(self, port, host="127.0.0.1"):
+        """
+        Serves prometheus() at http://host:port/metrics from a daemon thread.
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type",
+                                 "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # scrapes would otherwise be printed to stderr
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+def _metric_name(name):
+    return re.sub(r'[^a-zA-Z0-9_]', "_", name)
+
+
+def timed(metrics, name):
+    """
+    metrics.time(name) if there are metrics, otherwise a context manager
+    that does nothing, so callers do not have to check.
+    """
+    if metrics is None:
+        return _NO_TIMER
+    return metrics.time(name)
+
+
+class _NoTimer:
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NO_TIMER = _NoTimer()
@@ -1,6 +1,7 @@
 HEADER = "#HEADERS"
 PROMPTS = "#PROMPTS"
 USEFUL_SEARCH_TERMS = "#USEFUL_SEARCH_TERMS"
+SETTINGS = "#SETTINGS"
 
 SAVED_FOLDER = "saved_output_formats"
 DEFAULT_NAME = "scientometrics (default).txt"
@@ -12,6 +13,73 @@ RESERVED_COLUMNS = ["email", "emails", "Email", "Emails",
                     "Name", "name",
                     "Institution", "institution"]
 
+# tuning values that a saved format can override in its #SETTINGS section.
+#  The type of each default is the type the saved value is converted to.
+DEFAULT_SETTINGS = {
+    # searches are sent to search_url followed by the query. Only changed to
+    #  point a run at a stand-in search server (see bench_e2e.py)
+    'search_url': "https://www.google.com/search?q=",
+    # requests per second, and the burst size, allowed to each search host.
+    #  A search_rate of 0 does not limit the searches at all
+    'search_rate': 2.0,
+    'search_burst': 4,
+    # whether search results are cached on disk, for how long, and how large
+    #  the cache may grow
+    'search_cache': True,
+    'search_cache_days': 7.0,
+    'search_cache_mb': 200,
+    # the same for rendered pages. page_cache_days is how long a page is used
+    #  before the site is asked whether it has changed (see page_cache.py)
+    'page_cache': True,
+    'page_cache_days': 3.0,
+    'page_cache_mb': 1000,
+    # pages are fetched with plain HTTP first, and only rendered in chromium
+    #  when they turn out to need javascript (see fetcher.py)
+    'http_first': True,
+    # chromium does not download images, media, fonts, stylesheets, or ad and
+    #  analytics scripts, and reads pages at most settle_ms after their html
+    #  is parsed (see browser_pool.py). blocked_hosts adds comma separated
+    #  hosts to the ones that are always blocked
+    'block_resources': True,
+    'settle_ms': 1000,
+    'blocked_hosts': "",
+    # comma separated blocklists for the links found by searching (see
+    #  url_filter.py). A result link starting with any of bad_link_prefixes,
+    #  or containing any of bad_locations, is never used
+    'bad_link_prefixes': "/search,q=,/?,/advanced_search",
+    'bad_locations': "facebook,instagram,linkedin,twitter,ratemyprofessors,"
+                     "coursicle,youtube,amazon,.doc,.pdf,wiki,imgres",
+    # openai responses are remembered so that an identical call is never paid
+    #  for twice. Set llm_cache=false to always ask openai
+    'llm_cache': True,
+    'llm_cache_mb': 200,
+    # send all of the prompts for a page as one json mode request, as long as
+    #  the fused request and the webtext fit in fused_token_budget tokens
+    'fuse_prompts': True,
+    'fused_token_budget': 12000,
+    # the most tokens of a page's text sent with any one request
+    'token_budget': 6000,
+    # how many people are worked on at once in each stage of the pipeline,
+    #  how many of a person's pages are fetched together, and how many
+    #  chromium browsers are kept warm (see main.build_pipeline())
+    'search_workers': 2,
+    'fetch_workers': 2,
+    'llm_workers': 4,
+    'fetch_concurrency': 4,
+    'browsers': 2,
+    # how many processes parse pages, so that parsing does not hold up the
+    #  network threads and the GUI (see parse_pool.py). -1 sizes the pool to
+    #  the available cores, and 0 parses in the pipeline's threads instead
+    'parse_processes': -1,
+    # timings and counters of every run are saved next to the output as
+    #  <output>.metrics.json. A metrics_port above 0 also serves them, in
+    #  Prometheus' text format, at http://127.0.0.1:<port>/metrics
+    'metrics_port': 0,
+    # starting a run that did not finish again picks it up where it stopped
+    #  (see journal.py). resume=false always starts from the first person
+    'resume': True,
+}
+
 
 def build_prompts(columns):
     col_count = len(columns)
@@ -51,6 +119,27 @@ def build_prompts(columns):
     return prompts
 
 
+def fuse_prompts(prompts):
+    """
+    Combines a list of prompts (as made by build_prompts() or written by the
+    user) into a single prompt that asks for every field at once, so a page
+    needs one openai request instead of one per prompt. Each prompt is kept
+    word for word, so any extra instructions in them still apply.
+
+    return: the fused prompt, or None if there is nothing to fuse
+    """
+    prompts = [p for p in prompts if p.strip() != "" and p != "NONE"]
+    if len(prompts) < 2:
+        return None
+
+    fused = "Each numbered request below asks for information about the same" \
+        " individual. Answer all of them together as a single flat JSON" \
+        " object that contains every field asked for by every request."
+    for i, prompt in enumerate(prompts):
+        fused += "\n" + str(i + 1) + ". " + prompt
+    return fused
+
+
 def read_saved(saved_path):
     """
     This takes a saved format text file and retrieves the important
@@ -63,11 +152,21 @@ def read_saved(saved_path):
     headers_to_use = []
     prompts_to_use = []
     useful_search_terms = []
+    settings = {}
 
     with open(saved_path) as f:
         line = f.readline()
         while line:
-            if HEADER in line:
+            if SETTINGS in line:
+                # every line up to the next section is a key=value pair
+                line = f.readline()
+                while line and not line.startswith("#"):
+                    if "=" in line:
+                        key, value = line.split("\n")[0].split("=", 1)
+                        settings[key.strip()] = value.strip()
+                    line = f.readline()
+                continue
+            elif HEADER in line:
                 # Moving it along to get the line below
                 line = f.readline()
                 headers_to_use = line.split("\n")[0].split(",")
@@ -81,10 +180,31 @@ def read_saved(saved_path):
 
     saved_format = {'headers':  headers_to_use,
                     'prompts': prompts_to_use,
-                    'sites': useful_search_terms}
+                    'sites': useful_search_terms,
+                    'settings': settings}
     return saved_format
 
 
+def get_setting(saved_format, name):
+    """
+    Gets one of the DEFAULT_SETTINGS for some format dict, using the value
+    from the format's 'settings' if it has one. A value that cannot be
+    converted to the default's type is ignored.
+    """
+    default = DEFAULT_SETTINGS[name]
+    value = saved_format.get('settings', {}).get(name)
+    if value is None:
+        return default
+    if isinstance(default, bool):
+        if isinstance(value, bool):
+            return value
+        return str(value).lower() in ["true", "yes", "on", "1"]
+    try:
+        return type(default)(value)
+    except (TypeError, ValueError):
+        return default
+
+
 def save_format(to_save):
     """
     Where to_save is a dict containing
@@ -92,6 +212,7 @@ def save_format(to_save):
     'sites': additional sites, if any
     'prompts': prompts to use
     'name': the name of the saved format
+    'settings': optionally, a dict of DEFAULT_SETTINGS overrides
     """
     to_write = SAVED_FOLDER + "/" + to_save['name'] + ".txt"
 
@@ -100,6 +221,12 @@ def save_format(to_save):
         f.write(",".join(to_save['headers']) + "\n")
         f.write(USEFUL_SEARCH_TERMS + "\n")
         f.write(",".join(to_save['sites']) + "\n")
+        # the settings must come before the prompts, which run to the end
+        #  of the file
+        if to_save.get('settings'):
+            f.write(SETTINGS + "\n")
+            for key, value in to_save['settings'].items():
+                f.write(key + "=" + str(value) + "\n")
         f.write(PROMPTS + "\n")
         f.write("\n".join(to_save['prompts']))
 
@@ -109,6 +236,8 @@ def save_format(to_save):
 #  ColA,ColB,ColC,ColD
 #  #USEFUL_SEARCH_TERMS
 #  researchgate,ieee
+#  #SETTINGS
+#  search_rate=1.5
 #  #PROMPTS
 #  Given A, give me C
 #  Given B, give me A
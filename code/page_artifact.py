@@ -0,0 +1,110 @@
+import parsing
+
+
+class PageArtifact:
+    """
+    Everything that is known about one fetched page. It is made once per URL
+    and handed to every extractor (the email regex, gpt, and anything added
+    later), so that each page is downloaded once and parsed at most once.
+    The parsed tree, the text, and the anchors are only worked out the first
+    time they are asked for, and the text and anchors are pulled straight out
+    of the html by parsing.py without building the full tree.
+
+    Attributes:
+     url: the link the page was fetched from
+     html: the rendered DOM of the page, as a string. Empty if the page could
+      not be fetched
+     headers: the response headers of the page, if they are known
+     ok: False if the page could not be fetched
+
+    Properties:
+     tree: the full BeautifulSoup of html, for extractors that need it
+     text: the visible text of the page, flattened onto one line (the
+      webtext)
+     anchors: a list of (href, string) pairs, one per anchor element. Either
+      can be None. Can be set, when the page was parsed somewhere else
+     anchors_ready: whether the anchors have been worked out yet
+
+    Methods:
+     slim: a copy holding only the text and (if asked for) the anchors,
+      without the html
+    """
+
+    def __init__(self, url, html, headers=None, text=None, anchors=None,
+                 ok=True):
+        self.url = url
+        self.html = html
+        self.headers = headers or {}
+        self.ok = ok
+        self._tree = None
+        self._text = text
+        self._anchors = anchors
+
+
+    @classmethod
+    def from_page(cls, url, page, extracted=None):
+        """
+        Makes an artifact out of the dict given by BrowserPool.fetch().
+
+        extracted: the (text, anchors) pair of the page, if it was already
+         parsed by a parse_pool.ParsePool
+        """
+        text, anchors = extracted or (None, None)
+        return cls(url, page['html'], page.get('headers'), text, anchors)
+
+
+    @classmethod
+    def failed(cls, url):
+        """
+        An empty artifact for a page that could not be fetched.
+        """
+        return cls(url, "", text="", ok=False)
+
+
+    def slim(self, anchors=True):
+        """
+        A copy of the artifact without its html (or tree), for keeping around
+        after the page is done with. The text and anchors are worked out
+        first, if they were not yet, so the copy can still give them.
+
+        anchors: False if nobody will ask the copy for its anchors, which are
+         then not worked out (the copy keeps them only if they already were,
+         and has none otherwise)
+        """
+        if anchors or self.anchors_ready:
+            kept = self.anchors
+        else:
+            kept = []
+        return PageArtifact(self.url, "", self.headers, self.text, kept,
+                            self.ok)
+
+
+    @property
+    def tree(self):
+        if self._tree is None:
+            self._tree = parsing.parse(self.html)
+        return self._tree
+
+
+    @property
+    def text(self):
+        if self._text is None:
+            self._text = parsing.text(self.html)
+        return self._text
+
+
+    @property
+    def anchors(self):
+        if self._anchors is None:
+            self._anchors = parsing.anchors(self.html)
+        return self._anchors
+
+
+    @anchors.setter
+    def anchors(self, anchors):
+        self._anchors = anchors
+
+
+    @property
+    def anchors_ready(self):
+        return self._anchors is not None
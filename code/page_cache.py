@@ -0,0 +1,125 @@
+from urllib.parse import urlsplit
+import disk_cache
+import json
+import time
+
+# how long a cached page is used without asking the site whether it changed.
+#  Domains not listed use the page_cache_days setting. Profiles on these
+#  sites change rarely, so they can be trusted for longer.
+DOMAIN_TTLS = {
+    "researchgate.net": 30 * 86400,
+    "scholar.google.com": 14 * 86400,
+    "ieeexplore.ieee.org": 30 * 86400,
+    "orcid.org": 30 * 86400,
+}
+
+# seconds to wait for a site to answer a revalidation request
+REVALIDATE_TIMEOUT = 10
+
+
+class PageCache:
+    """
+    A compressed, size-capped cache of rendered pages, keyed by URL. Each
+    entry holds the rendered html, the text that was extracted from it, and
+    the ETag/Last-Modified headers the site sent with it.
+
+    A cached page younger than its domain's TTL is used as is. An older one
+    is revalidated with a conditional request: if the site answers 304 Not
+    Modified the cached page is used again, otherwise the page has to be
+    rendered again.
+
+    Attributes:
+     cache: the disk_cache.DiskCache holding the entries
+     default_ttl: the TTL, in seconds, of domains not in DOMAIN_TTLS
+     revalidated: how many stale pages were kept thanks to a 304
+
+    Methods:
+     lookup: returns the cached entry for a URL if it can still be used
+     store: saves a freshly rendered page
+     stats: a short string for the log
+     close: closes the underlying cache
+    """
+
+    def __init__(self, default_ttl, max_bytes):
+        self.cache = disk_cache.DiskCache("pages", max_bytes=max_bytes,
+                                          compress=True)
+        self.default_ttl = default_ttl
+        self.revalidated = 0
+
+
+    def ttl_for(self, url):
+        host = urlsplit(url).netloc.lower()
+        for domain, ttl in DOMAIN_TTLS.items():
+            if host == domain or host.endswith("." + domain):
+                return ttl
+        return self.default_ttl
+
+
+    def lookup(self, url, session):
+        """
+        url: the link that is about to be rendered
+        session: a requests.Session used for revalidation requests
+        return: the cached entry, a dict containing 'url', 'html', 'text',
+         'etag', 'last_modified', and 'fetched', or None if the page has to
+         be rendered again
+        """
+        value = self.cache.get(url)
+        if value is None:
+            return None
+        entry = json.loads(value)
+
+        if time.time() - entry['fetched'] <= self.ttl_for(url):
+            return entry
+
+        # the entry is stale; it can only be reused if the site can say that
+        #  the page has not changed
+        headers = {}
+        if entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+        if not headers:
+            return None
+        try:
+            req = session.get(url, headers=headers, timeout=REVALIDATE_TIMEOUT,
+                              stream=True)
+            req.close()
+        except Exception:
+            return None
+        if req.status_code != 304:
+            return None
+
+        self.revalidated += 1
+        entry['fetched'] = time.time()
+        self._put(entry)
+        return entry
+
+
+    def store(self, url, page, text):
+        """
+        url: the link that was rendered
+        page: the dict given by browser_pool.BrowserPool.fetch()
+        text: the webtext that was extracted from the page
+        """
+        headers = {k.lower(): v for k, v in page.get('headers', {}).items()}
+        self._put({
+            'url': url,
+            'html': page['html'],
+            'text': text,
+            'etag': headers.get('etag'),
+            'last_modified': headers.get('last-modified'),
+            'fetched': time.time()
+        })
+
+
+    def _put(self, entry):
+        self.cache.put(entry['url'], json.dumps(entry).encode("utf-8"))
+
+
+    def stats(self):
+        return self.cache.stats() + ", " + str(self.revalidated) + \
+            " revalidated"
+
+
+    def close(self):
+        self.cache.close()
@@ -0,0 +1,137 @@
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import os
+import parsing
+
+# pages smaller than this are parsed in the calling thread; sending them to
+#  another process would cost more than parsing them
+MIN_POOL_BYTES = 20 * 1024
+
+
+def available_cores():
+    """
+    The number of cores this process may run on, which can be fewer than the
+    machine has (containers, taskset).
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def default_size():
+    # one core is left for the GUI, the network threads, and the browsers
+    return max(1, available_cores() - 1)
+
+
+def _extract(html):
+    """
+    Runs in a pool process. Only the raw bytes go in and only plain strings
+    come out, so nothing of the parsed tree is ever pickled.
+    """
+    html = html.decode("utf-8", errors="replace")
+    return parsing.text(html), parsing.anchors(html)
+
+
+def _anchors(html):
+    return parsing.anchors(html)
+
+
+class ParsePool:
+    """
+    A pool of processes that parses pages, so that parsing big pages does not
+    hold the GIL that the network threads and the GUI need. Pages go in as
+    raw html bytes and come back as their text and a list of anchors (see
+    parsing.text() and parsing.anchors()).
+
+    Small pages are parsed in the calling thread instead, and if the pool
+    breaks (a process was killed) parsing carries on in the calling thread
+    for the rest of the run.
+
+    Attributes:
+     size: the number of processes
+     executor: the ProcessPoolExecutor, or None once it has broken
+
+    Methods:
+     extract: the text and anchors of each of a list of pages
+     anchors: the anchors of each of a list of pages
+     close: stops the processes
+    """
+
+    def __init__(self, size=None):
+        self.size = size or default_size()
+        # spawn, rather than fork, so that the processes never inherit the
+        #  threads (or the Qt state) of the process that starts them
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.size,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+
+
+    def _map(self, func, local, pages):
+        """
+        Runs func in the pool over the big pages, and local in this thread
+        over the small ones. The results are in the same order as pages, and
+        a page that could not be parsed has the exception raised in its place.
+        """
+        def run_local(html):
+            try:
+                return local(html)
+            except Exception as e:
+                return e
+
+        encoded = [html.encode("utf-8") if isinstance(html, str) else html
+                   for html in pages]
+        results = [None] * len(pages)
+        big = [i for i, html in enumerate(encoded)
+               if len(html) >= MIN_POOL_BYTES]
+
+        futures = {}
+        # read once, since another thread may find the pool broken meanwhile
+        executor = self.executor
+        if executor is not None:
+            try:
+                futures = {i: executor.submit(func, encoded[i]) for i in big}
+            except (BrokenProcessPool, RuntimeError):
+                self.executor = None
+                futures = {}
+
+        for i, html in enumerate(pages):
+            if i not in futures:
+                results[i] = run_local(html)
+        for i, future in futures.items():
+            try:
+                results[i] = future.result()
+            except BrokenProcessPool:
+                self.executor = None
+                results[i] = run_local(pages[i])
+            except Exception as e:
+                results[i] = e
+        return results
+
+
+    def extract(self, pages):
+        """
+        pages: a list of html strings or bytes
+        return: a list of (text, anchors) pairs, one per page, or of the
+         exception raised while parsing it
+        """
+        return self._map(_extract,
+                         lambda html: (parsing.text(html),
+                                       parsing.anchors(html)),
+                         pages)
+
+
+    def anchors(self, pages):
+        """
+        pages: a list of html strings or bytes
+        return: a list of the anchors of each page, or of the exception
+         raised while parsing it
+        """
+        return self._map(_anchors, parsing.anchors, pages)
+
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,119 @@
+from bs4 import BeautifulSoup, SoupStrainer
+from html.parser import HTMLParser
+
+# lxml's C parser is used when it is installed; otherwise everything falls
+#  back to python's own html.parser, which gives the same results, slower
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
+BACKENDS = ["lxml", "html.parser"] if etree is not None else ["html.parser"]
+BACKEND = BACKENDS[0]
+
+# elements whose contents are never part of the visible text of a page
+INVISIBLE_TAGS = ("script", "style", "template")
+
+_ANCHORS_ONLY = SoupStrainer("a")
+
+
+def clean_text(text):
+    """
+    Flattens the text of a page onto one line, the same way the webtext has
+    always been cleaned before it is given to gpt.
+    """
+    return text.replace('\n', '').replace('"', '').replace("\xa0", '').strip()
+
+
+def parse(html, backend=None):
+    """
+    Builds the full BeautifulSoup tree of html (a string or bytes). Only
+    needed when an extractor has to walk the whole page; text() and anchors()
+    are much cheaper.
+    """
+    return BeautifulSoup(html, backend or BACKEND)
+
+
+def anchors(html, backend=None):
+    """
+    Gets every anchor element of html without building the rest of the tree.
+
+    html: a page, as a string or bytes
+    backend: the BeautifulSoup parser to use, BACKEND by default
+    return: a list of (href, string) pairs, one per anchor element, in page
+     order. Either can be None. Both are plain strings, so the list does not
+     keep the parsed tree alive
+    """
+    if not html:
+        return []
+    soup = BeautifulSoup(html, backend or BACKEND, parse_only=_ANCHORS_ONLY)
+    return [(a.get('href'), None if a.string is None else str(a.string))
+            for a in soup.find_all("a")]
+
+
+class _TextParser(HTMLParser):
+    """
+    Collects the visible text of a page as it is read, without keeping any of
+    its elements.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.parts = []
+        self.hidden = 0
+
+
+    def handle_starttag(self, tag, attrs):
+        if tag in INVISIBLE_TAGS:
+            self.hidden += 1
+
+
+    def handle_endtag(self, tag):
+        if tag in INVISIBLE_TAGS and self.hidden > 0:
+            self.hidden -= 1
+
+
+    def handle_data(self, data):
+        if self.hidden == 0:
+            self.parts.append(data)
+
+
+def _lxml_text(html):
+    parser = etree.HTMLParser()
+    if isinstance(html, str):
+        # lxml refuses strings that still declare their encoding
+        html = html.encode("utf-8")
+        parser = etree.HTMLParser(encoding="utf-8")
+    root = etree.fromstring(html, parser)
+    if root is None:
+        return ""
+    etree.strip_elements(root, *INVISIBLE_TAGS, etree.Comment,
+                         with_tail=False)
+    return "".join(root.itertext())
+
+
+def _html_parser_text(html):
+    if isinstance(html, bytes):
+        html = html.decode("utf-8", errors="replace")
+    parser = _TextParser()
+    parser.feed(html)
+    parser.close()
+    return "".join(parser.parts)
+
+
+def text(html, backend=None):
+    """
+    Gets the visible text of html, cleaned by clean_text(), without ever
+    building a BeautifulSoup tree. Script, style, and template contents are
+    left out, as get_text() does.
+
+    html: a page, as a string or bytes
+    backend: "lxml" or "html.parser", BACKEND by default
+    """
+    if not html:
+        return ""
+    if (backend or BACKEND) == "lxml":
+        raw = _lxml_text(html)
+    else:
+        raw = _html_parser_text(html)
+    return clean_text(raw)
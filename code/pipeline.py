@@ -0,0 +1,220 @@
+import queue
+import threading
+
+# how long a blocked worker waits on a queue before checking whether the
+#  pipeline has been stopped
+POLL_SECONDS = 0.2
+
+# put into a stage's queue once per worker to tell the workers to finish
+_DONE = object()
+
+
+class Stage:
+    """
+    One step of a Pipeline.
+
+    Attributes:
+     name: used when reporting errors
+     func: called with each person dict, and returns that person dict once
+      this step has been done to it
+     workers: how many threads run func at the same time
+     queue_size: how many people may wait in front of this stage before the
+      stage feeding it has to block
+    """
+
+    def __init__(self, name, func, workers=1, queue_size=8):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.queue_size = queue_size
+
+
+class Pipeline:
+    """
+    Runs people through a list of stages, each stage having its own bounded
+    queue and its own pool of worker threads, so that many people are being
+    worked on at once. Once a person is through every stage they are handed
+    to a single writer, which always receives people in the order they came
+    in, no matter what order they finish in. The people that finish early
+    wait for the writer, so the number of people taken from the input but
+    not yet written is capped at what the queues and workers can hold;
+    otherwise a single slow person would let the rest of the input be read
+    into memory behind them.
+
+    Attributes:
+     stages: the list of Stage objects, in the order people go through them
+     writer: called with (index, person) for each finished person, in input
+      order. If it returns False the pipeline stops
+     error: the exception (and the name of the stage it came from) that
+      stopped the pipeline, if there was one
+
+    Methods:
+     run: feeds people through the stages and the writer, blocking until
+      every person is written or the pipeline is stopped
+     stop: makes every thread of the pipeline wind down
+    """
+
+    def __init__(self, stages, writer):
+        self.stages = stages
+        self.writer = writer
+        self.error = None
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+
+
+    def stop(self):
+        self._stopped.set()
+
+
+    def _put(self, q, item):
+        """
+        Blocks until there is room in q, unless the pipeline is stopped first.
+        Returns False if the item could not be put.
+        """
+        while not self._stopped.is_set():
+            try:
+                q.put(item, timeout=POLL_SECONDS)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+
+    def _get(self, q):
+        """
+        Blocks until something is in q. Returns _DONE if the pipeline is
+        stopped in the meantime.
+        """
+        while not self._stopped.is_set():
+            try:
+                return q.get(timeout=POLL_SECONDS)
+            except queue.Empty:
+                continue
+        return _DONE
+
+
+    def _acquire(self, semaphore):
+        """
+        Blocks until semaphore is acquired, unless the pipeline is stopped
+        first. Returns False if it could not be acquired.
+        """
+        while not self._stopped.is_set():
+            if semaphore.acquire(timeout=POLL_SECONDS):
+                return True
+        return False
+
+
+    def _feed(self, people, first_queue, first_workers, in_flight):
+        try:
+            for index, person in enumerate(people):
+                # a place is taken for every person, and only given back
+                #  once they are written
+                if not self._acquire(in_flight):
+                    return
+                if not self._put(first_queue, (index, person)):
+                    return
+        except Exception as e:
+            self._fail("input", e)
+        finally:
+            for _ in range(first_workers):
+                self._put(first_queue, _DONE)
+
+
+    def _work(self, stage, in_queue, out_queue, out_workers, remaining):
+        while True:
+            item = self._get(in_queue)
+            if item is _DONE:
+                break
+            index, person = item
+            try:
+                person = stage.func(person)
+            except Exception as e:
+                self._fail(stage.name, e)
+                break
+            if not self._put(out_queue, (index, person)):
+                break
+
+        # the last worker of a stage to finish tells the next stage that
+        #  nothing else is coming
+        with self._lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            for _ in range(out_workers):
+                self._put(out_queue, _DONE)
+
+
+    def _fail(self, stage_name, err):
+        with self._lock:
+            if self.error is None:
+                self.error = (stage_name, err)
+        self.stop()
+
+
+    def run(self, people):
+        """
+        people: any iterable of person dicts; it is only read as fast as the
+         first stage has room for
+        return: True if every person made it through the writer, False if
+         the pipeline was stopped (by the writer or by an error, which is
+         kept in self.error)
+        """
+        queues = [queue.Queue(maxsize=stage.queue_size)
+                  for stage in self.stages]
+        # the writer's queue, which gets a single _DONE
+        queues.append(queue.Queue(maxsize=self.stages[-1].queue_size))
+        workers = [stage.workers for stage in self.stages] + [1]
+        # as many people as every queue and worker can hold at once
+        in_flight = threading.Semaphore(
+            sum(q.maxsize for q in queues) + sum(workers)
+        )
+
+        threads = [threading.Thread(
+            target=self._feed,
+            args=(people, queues[0], workers[0], in_flight),
+            daemon=True
+        )]
+        for i, stage in enumerate(self.stages):
+            remaining = [stage.workers]
+            for _ in range(stage.workers):
+                threads.append(threading.Thread(
+                    target=self._work,
+                    args=(stage, queues[i], queues[i + 1], workers[i + 1],
+                          remaining),
+                    daemon=True
+                ))
+        for thread in threads:
+            thread.start()
+
+        finished = self._write(queues[-1], in_flight)
+
+        self.stop()
+        for thread in threads:
+            thread.join()
+        return finished and self.error is None
+
+
+    def _write(self, write_queue, in_flight):
+        """
+        The single, ordered consumer at the end of the pipeline. People that
+        finish early are held until everyone before them has been written.
+        """
+        waiting = {}
+        next_index = 0
+        while True:
+            item = self._get(write_queue)
+            if item is _DONE:
+                return not self._stopped.is_set()
+            index, person = item
+            waiting[index] = person
+            while next_index in waiting:
+                try:
+                    good = self.writer(next_index, waiting.pop(next_index))
+                except Exception as e:
+                    self._fail("write", e)
+                    return False
+                in_flight.release()
+                if good is False:
+                    self.stop()
+                    return False
+                next_index += 1
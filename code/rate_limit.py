@@ -0,0 +1,93 @@
+from urllib.parse import urlsplit
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    A thread-safe token bucket. Tokens are added at a steady rate up to a
+    maximum (the burst), and each request has to take one before it is sent.
+
+    Attributes:
+     rate: tokens added per second. A rate of 0 or less means no limit
+     burst: the most tokens the bucket can hold, ie how many requests can go
+      out back to back after a quiet period
+
+    Methods:
+     acquire: blocks until a token is available, then takes it
+     try_acquire: takes a token if one is available, without waiting
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+
+    def acquire(self):
+        """
+        Blocks until a token could be taken. Returns the seconds spent waiting.
+        """
+        if self.rate <= 0:
+            return 0
+        waited = 0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + \
+                                  (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+
+    def try_acquire(self):
+        """
+        return: True if a token was taken, False if there was none
+        """
+        if self.rate <= 0:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + \
+                              (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+
+class HostRateLimiter:
+    """
+    Keeps a separate TokenBucket for each host that requests are sent to, so
+    that one site's limit does not slow down requests to another.
+
+    Attributes:
+     rate: the tokens per second given to each host's bucket
+     burst: the size of each host's bucket
+
+    Methods:
+     acquire: waits for a token from the bucket belonging to some URL's host
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+
+    def acquire(self, url):
+        host = urlsplit(url).netloc.lower()
+        with self.lock:
+            if host not in self.buckets:
+                self.buckets[host] = TokenBucket(self.rate, self.burst)
+            bucket = self.buckets[host]
+        return bucket.acquire()
@@ -0,0 +1,508 @@
+"""
+Runs one scrape across several processes, on one machine or many. From the
+repository folder:
+
+    python code/shard.py init INPUT.csv FORMAT OUTPUT.xlsx SHARD_DIR
+    python code/shard.py work SHARD_DIR [--processes N]     (on every machine)
+    python code/shard.py status SHARD_DIR
+    python code/shard.py merge SHARD_DIR
+
+init copies the input csv and the format into SHARD_DIR and splits the
+people into chunks in a SQLite work queue there. Every worker process claims
+a chunk at a time, scrapes it with its own browsers and connection pools, and
+writes the chunk's rows to a part file in SHARD_DIR/parts. merge builds the
+final Excel file from the parts, in input order.
+
+For several machines, SHARD_DIR has to be a shared directory whose file
+locks work (SQLite is kept out of WAL mode so that they are all it needs).
+Each process rate limits its own searches, so search_rate should be divided
+by the total number of worker processes when they share one egress path.
+"""
+import argparse
+import cli
+import csv_index
+import itertools
+import json
+import os
+import output_format
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+
+QUEUE_FILE = "queue.sqlite"
+INPUT_FILE = "input.csv"
+PARTS_FOLDER = "parts"
+
+# how many people a worker claims at a time
+CHUNK_SIZE = 20
+
+# a claimed chunk whose worker has not been heard from for this many seconds
+#  is given to another worker. Workers renew their claim far more often
+LEASE_SECONDS = 300
+RENEW_SECONDS = 60
+
+TODO = "todo"
+CLAIMED = "claimed"
+DONE = "done"
+
+
+class WorkQueue:
+    """
+    The SQLite queue of chunks of people in a shard directory. A chunk is a
+    range [start, end) of rows of the input csv. Claims are leases: a worker
+    that dies simply stops renewing its lease, and the chunk goes back to
+    being claimable once the lease runs out.
+
+    Attributes:
+     folder: the shard directory
+     job: a dict of what is being scraped: 'format' (the format dict),
+      'output' (the default path of the merged Excel file), and 'total' (the
+      number of people)
+
+    Methods:
+     create: (classmethod) sets up a new queue for a job
+     claim: gives a worker the next chunk that needs doing
+     renew: extends a worker's lease on a chunk
+     complete: marks a chunk as done
+     release: gives a chunk back without finishing it
+     counts: how many chunks are in each state
+     done_chunks: every finished chunk, in input order
+     close: closes the database
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.conn = sqlite3.connect(os.path.join(folder, QUEUE_FILE),
+                                    timeout=60, isolation_level=None,
+                                    check_same_thread=False)
+        self.lock = threading.Lock()
+        self.job = {key: json.loads(value) for key, value
+                    in self.conn.execute("SELECT key, value FROM job")}
+
+
+    @classmethod
+    def create(cls, folder, job, total, chunk_size=CHUNK_SIZE):
+        conn = sqlite3.connect(os.path.join(folder, QUEUE_FILE))
+        conn.execute("CREATE TABLE job (key TEXT PRIMARY KEY, value TEXT)")
+        conn.execute(
+            "CREATE TABLE chunks ("
+            " start INTEGER PRIMARY KEY,"
+            " end INTEGER NOT NULL,"
+            " state TEXT NOT NULL,"
+            " worker TEXT,"
+            " lease_until REAL,"
+            " attempts INTEGER NOT NULL DEFAULT 0)"
+        )
+        conn.executemany("INSERT INTO job VALUES (?, ?)",
+                         [(key, json.dumps(value))
+                          for key, value in dict(job, total=total).items()])
+        conn.executemany(
+            "INSERT INTO chunks (start, end, state) VALUES (?, ?, ?)",
+            [(start, min(start + chunk_size, total), TODO)
+             for start in range(0, total, chunk_size)]
+        )
+        conn.commit()
+        conn.close()
+        return cls(folder)
+
+
+    def claim(self, worker):
+        """
+        return: (start, end) of the chunk now leased to worker, or None if
+         every chunk is done or leased to a live worker
+        """
+        now = time.time()
+        with self.lock:
+            # BEGIN IMMEDIATE takes the write lock up front, so two workers
+            #  can never both see the same chunk as free
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.conn.execute(
+                    "SELECT start, end FROM chunks WHERE state = ?"
+                    " OR (state = ? AND lease_until < ?)"
+                    " ORDER BY start LIMIT 1", (TODO, CLAIMED, now)
+                ).fetchone()
+                if row is not None:
+                    self.conn.execute(
+                        "UPDATE chunks SET state = ?, worker = ?,"
+                        " lease_until = ?, attempts = attempts + 1"
+                        " WHERE start = ?",
+                        (CLAIMED, worker, now + LEASE_SECONDS, row[0])
+                    )
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+        return row
+
+
+    def _update(self, sql, args):
+        with self.lock:
+            return self.conn.execute(sql, args).rowcount
+
+
+    def renew(self, start, worker):
+        """
+        return: False if the chunk is no longer leased to worker (its lease ran
+         out and someone else took it)
+        """
+        return self._update(
+            "UPDATE chunks SET lease_until = ?"
+            " WHERE start = ? AND worker = ? AND state = ?",
+            (time.time() + LEASE_SECONDS, start, worker, CLAIMED)
+        ) == 1
+
+
+    def complete(self, start, worker):
+        return self._update(
+            "UPDATE chunks SET state = ?, lease_until = NULL"
+            " WHERE start = ? AND worker = ? AND state = ?",
+            (DONE, start, worker, CLAIMED)
+        ) == 1
+
+
+    def release(self, start, worker):
+        self._update(
+            "UPDATE chunks SET state = ?, worker = NULL, lease_until = NULL"
+            " WHERE start = ? AND worker = ? AND state = ?",
+            (TODO, start, worker, CLAIMED)
+        )
+
+
+    def counts(self):
+        with self.lock:
+            counts = dict(self.conn.execute(
+                "SELECT state, COUNT(*) FROM chunks GROUP BY state"
+            ))
+        return {state: counts.get(state, 0) for state in [TODO, CLAIMED, DONE]}
+
+
+    def done_chunks(self):
+        with self.lock:
+            return self.conn.execute(
+                "SELECT start, end FROM chunks WHERE state = ? ORDER BY start",
+                (DONE,)
+            ).fetchall()
+
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def part_path(folder, start):
+    return os.path.join(folder, PARTS_FOLDER, "%09d.jsonl" % start)
+
+
+class PartWriter:
+    """
+    Takes the place of the excel_writer.ExcelWriter in a worker's pipeline.
+    Each row is written as a JSON line, with the csv row of its person, to a
+    temporary file that replaces the chunk's part file once the whole chunk
+    is written, so a part file is always complete. The temporary file is
+    named after the worker, since a chunk whose lease ran out can be worked
+    on by two workers at once.
+
+    The pipeline writes people in input order, so the n-th row appended
+    belongs to the n-th person of the chunk.
+
+    Attributes:
+     path: the part file of the chunk
+     temp_path: the worker's temporary file for it
+     header: the output column names
+     start: the csv row of the first person of the chunk
+     rows: the number of rows appended
+     saved_rows: the number of rows written to the temporary file
+    """
+
+    def __init__(self, path, header, start, worker):
+        self.path = path
+        self.temp_path = path + ".tmp." + worker
+        self.header = header
+        self.start = start
+        self.rows = 0
+        self.saved_rows = 0
+        self.file = open(self.temp_path, "w", encoding="utf-8")
+
+
+    def append(self, row):
+        self.file.write(json.dumps({'index': self.start + self.rows,
+                                    'row': row}) + "\n")
+        self.rows += 1
+        self.saved_rows = self.rows
+
+
+    def discard(self):
+        self.file.close()
+        os.remove(self.temp_path)
+
+
+    def close(self):
+        self.file.close()
+        os.replace(self.temp_path, self.path)
+
+
+def init(args):
+    folder = args.shard_dir
+    if os.path.exists(os.path.join(folder, QUEUE_FILE)):
+        return "there is already a queue in " + folder
+    format_path = cli.find_format(args.format)
+    if format_path is None:
+        return "there is no saved format called " + args.format
+    if not os.path.isfile(args.input):
+        return "the input file " + args.input + " does not exist"
+
+    saved_format = output_format.read_saved(format_path)
+    saved_format['settings'].update(cli.settings_from_args(args, args.parser))
+
+    os.makedirs(os.path.join(folder, PARTS_FOLDER), exist_ok=True)
+    shutil.copyfile(args.input, os.path.join(folder, INPUT_FILE))
+    total = len(csv_index.CsvIndex(os.path.join(folder, INPUT_FILE)))
+    queue = WorkQueue.create(folder, {'format': saved_format,
+                                      'output': os.path.abspath(args.output)},
+                             total, args.chunk_size)
+    print(json.dumps({'event': "initialized", 'people': total,
+                      'chunks': sum(queue.counts().values())}))
+    queue.close()
+
+
+def _renew_until(stop, queue, start, worker, lost, scraper):
+    """
+    Renews the lease on a chunk until stop is set. If the lease was lost
+    (someone else took the chunk), lost is set and the chunk's pipeline is
+    stopped, since its rows would be thrown away anyway.
+    """
+    while not stop.wait(RENEW_SECONDS):
+        if not queue.renew(start, worker):
+            lost.set()
+            scraper.stop()
+            return
+
+
+def work(args):
+    if args.processes > 1:
+        return spawn_workers(args)
+
+    # imported here so that init, status, and merge do not need playwright,
+    #  openai, and the rest
+    import analysis
+    import journal
+    import main
+
+    folder = args.shard_dir
+    worker = args.worker_id or socket.gethostname() + "-" + str(os.getpid())
+    queue = WorkQueue(folder)
+    saved_format = queue.job['format']
+    saved_format['settings'].update(cli.settings_from_args(args, args.parser))
+    input_path = os.path.join(folder, INPUT_FILE)
+    log = cli.JsonLinesEmitter("log", fields={'worker': worker})
+    table = cli.JsonLinesEmitter("table", fields={'worker': worker})
+
+    people_index = main.read_csv(input_path, table, log)
+    if not people_index:
+        return cli.EXIT_FAILED
+    client = analysis.animate_client()
+    get_email = main.wants_emails(saved_format['headers'])
+    resources = main.start_resources(saved_format, log)
+    # a chunk that comes back to a worker on the same machine after a crash
+    #  picks up where it stopped
+    run_journal = journal.RunJournal(
+        journal.run_id(input_path, saved_format, queue.job['output'])
+    )
+
+    status = cli.EXIT_OK
+    try:
+        while True:
+            claimed = queue.claim(worker)
+            if claimed is None:
+                break
+            start, end = claimed
+            log.write({'event': "claimed", 'start': start, 'end': end})
+
+            writer = PartWriter(part_path(folder, start),
+                                saved_format['headers'], start, worker)
+            scraper = main.build_pipeline(writer, saved_format, client,
+                                          get_email, resources, run_journal,
+                                          log, table)
+            stop = threading.Event()
+            lost = threading.Event()
+            renewer = threading.Thread(
+                target=_renew_until,
+                args=(stop, queue, start, worker, lost, scraper),
+                daemon=True
+            )
+            renewer.start()
+            try:
+                people = main.iter_people(people_index, start)
+                finished = scraper.run(
+                    itertools.islice(people, end - start)
+                )
+            finally:
+                stop.set()
+                renewer.join()
+
+            # the part is only published by the worker that still holds the
+            #  chunk; one whose lease ran out leaves it to the new holder
+            whole = finished and writer.rows == end - start
+            if lost.is_set() or (whole and not queue.complete(start, worker)):
+                writer.discard()
+                log.write({'event': "lost", 'start': start, 'end': end})
+            elif whole:
+                writer.close()
+                run_journal.clear(start, end)
+                log.write({'event': "done", 'start': start, 'end': end})
+            else:
+                writer.discard()
+                queue.release(start, worker)
+                if scraper.error is not None:
+                    log.write({'event': "error", 'stage': scraper.error[0],
+                               'message': repr(scraper.error[1])})
+                status = cli.EXIT_FAILED
+                break
+    finally:
+        main.stop_resources(resources, log)
+        main.save_metrics(resources['metrics'],
+                          os.path.join(folder, PARTS_FOLDER, worker), log)
+        run_journal.close()
+        queue.close()
+    return status
+
+
+def spawn_workers(args):
+    """
+    Starts args.processes worker processes on this machine, each running
+    `work` on its own, and waits for all of them. Unless parse_processes is
+    set, the cores are split between the workers' parse pools, instead of
+    each of them starting one as big as the machine.
+    """
+    import parse_pool
+
+    # the children get the same arguments, without --processes
+    argv = []
+    skip = False
+    for arg in args.argv:
+        if skip or arg.startswith("--processes="):
+            skip = False
+            continue
+        if arg == "--processes":
+            skip = True
+            continue
+        argv.append(arg)
+
+    queue = WorkQueue(args.shard_dir)
+    saved_format = queue.job['format']
+    queue.close()
+    saved_format['settings'].update(cli.settings_from_args(args, args.parser))
+    if output_format.get_setting(saved_format, 'parse_processes') < 0:
+        argv += ["--set", "parse_processes=" + str(
+            max(1, parse_pool.available_cores() // args.processes))]
+
+    host = socket.gethostname() + "-" + str(os.getpid())
+    children = [subprocess.Popen([sys.executable, os.path.abspath(__file__)]
+                                 + argv + ["--worker-id", host + "-" + str(n)])
+                for n in range(args.processes)]
+    codes = [child.wait() for child in children]
+    return max(codes)
+
+
+def status(args):
+    queue = WorkQueue(args.shard_dir)
+    print(json.dumps(dict(queue.counts(), people=queue.job['total'])))
+    queue.close()
+
+
+def merge(args):
+    import excel_writer
+
+    folder = args.shard_dir
+    queue = WorkQueue(folder)
+    counts = queue.counts()
+    if counts[DONE] != sum(counts.values()) and not args.partial:
+        queue.close()
+        return str(counts[TODO] + counts[CLAIMED]) + " chunks are not done" \
+            " yet (use --partial to merge what is)"
+
+    output = args.output or queue.job['output']
+    # a merge that dies is simply run again from the parts, so the rows are
+    #  never forced to disk on the way, and the workbook is saved once
+    writer = excel_writer.ExcelWriter(output, queue.job['format']['headers'],
+                                      flush_rows=sys.maxsize,
+                                      flush_seconds=float("inf"),
+                                      save_seconds=float("inf"))
+    rows = 0
+    try:
+        for start, end in queue.done_chunks():
+            with open(part_path(folder, start), encoding="utf-8") as f:
+                part = [json.loads(line) for line in f]
+            for entry in sorted(part, key=lambda entry: entry['index']):
+                writer.append(entry['row'])
+                rows += 1
+    finally:
+        writer.close()
+        queue.close()
+    print(json.dumps({'event': "merged", 'rows': rows, 'output': output}))
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        description="Split a scrape across worker processes and machines."
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    command = commands.add_parser("init", help="set up a shard directory")
+    command.add_argument("input", help="the input csv")
+    command.add_argument("format", help="a saved format name or path, or"
+                         " 'base' for the default format")
+    command.add_argument("output", help="the Excel file merge will write")
+    command.add_argument("shard_dir", help="the (shared) shard directory")
+    command.add_argument("--chunk-size", type=int, default=CHUNK_SIZE,
+                         help="how many people a worker claims at a time")
+    cli.add_settings_arguments(command)
+    command.set_defaults(run=init, parser=command)
+
+    command = commands.add_parser("work", help="claim and scrape chunks"
+                                  " until none are left")
+    command.add_argument("shard_dir")
+    command.add_argument("--processes", type=int, default=1,
+                         help="how many worker processes to start here")
+    command.add_argument("--worker-id", help=argparse.SUPPRESS)
+    cli.add_settings_arguments(command)
+    command.set_defaults(run=work, parser=command)
+
+    command = commands.add_parser("status", help="show how many chunks are"
+                                  " done")
+    command.add_argument("shard_dir")
+    command.set_defaults(run=status)
+
+    command = commands.add_parser("merge", help="build the Excel file from"
+                                  " the finished chunks")
+    command.add_argument("shard_dir")
+    command.add_argument("--output", help="write here instead of the output"
+                         " given to init")
+    command.add_argument("--partial", action="store_true",
+                         help="merge even if some chunks are not done")
+    command.set_defaults(run=merge)
+    return parser
+
+
+def run(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    args = build_parser().parse_args(argv)
+    args.argv = argv
+    try:
+        result = args.run(args)
+    except KeyboardInterrupt:
+        return cli.EXIT_INTERRUPTED
+    if isinstance(result, str):
+        print(json.dumps({'event': "error", 'message': result}))
+        return cli.EXIT_FAILED
+    return result or cli.EXIT_OK
+
+
+if __name__ == "__main__":
+    sys.exit(run())
@@ -0,0 +1,77 @@
+import tiktoken
+import threading
+
+# the size, in tokens, of the pieces an oversized webtext is cut into
+CHUNK_TOKENS = 500
+
+_encodings = {}
+_lock = threading.Lock()
+
+
+def get_encoding(model):
+    """
+    Gets (and remembers) the tiktoken encoding for model. If tiktoken does
+    not know the model, the encoding of the gpt-3.5/gpt-4 family is used.
+    """
+    with _lock:
+        if model not in _encodings:
+            try:
+                _encodings[model] = tiktoken.encoding_for_model(model)
+            except KeyError:
+                _encodings[model] = tiktoken.get_encoding("cl100k_base")
+        return _encodings[model]
+
+
+def count_tokens(text, model):
+    """
+    The number of tokens text is for model.
+    """
+    return len(get_encoding(model).encode(text, disallowed_special=()))
+
+
+def split_chunks(text, model, chunk_tokens=CHUNK_TOKENS):
+    """
+    Cuts text into pieces of at most chunk_tokens tokens each, in order.
+    """
+    encoding = get_encoding(model)
+    encoded = encoding.encode(text, disallowed_special=())
+    return [encoding.decode(encoded[i:i + chunk_tokens])
+            for i in range(0, len(encoded), chunk_tokens)]
+
+
+def fit_to_budget(text, model, budget, keywords=()):
+    """
+    Trims a webtext so that it is at most budget tokens long. Text that
+    already fits is returned as it is. Otherwise it is split into chunks and
+    chunks are kept until the budget is used up: first the chunks that
+    mention any of the keywords (the most mentions first), then the rest in
+    page order. The kept chunks are put back together in page order.
+
+    text: the webtext
+    model: the model the text will be sent to
+    budget: the most tokens the returned text may be
+    keywords: strings, such as the person's name, that mark useful chunks
+    """
+    if count_tokens(text, model) <= budget:
+        return text
+
+    chunks = split_chunks(text, model)
+    keywords = [k.lower() for k in keywords if k]
+
+    def mentions(chunk):
+        lowered = chunk.lower()
+        return sum(lowered.count(k) for k in keywords)
+
+    # the chunk indices ranked by how useful they look; ties stay in page
+    #  order since sorted() is stable
+    ranked = sorted(range(len(chunks)), key=lambda i: -mentions(chunks[i]))
+
+    kept = []
+    used = 0
+    for i in ranked:
+        size = count_tokens(chunks[i], model)
+        if used + size > budget:
+            continue
+        kept.append(i)
+        used += size
+    return "".join(chunks[i] for i in sorted(kept))
@@ -0,0 +1,151 @@
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+import re
+
+# search result hrefs starting with any of these are google's own links
+BAD_LINK_PREFIXES = ["/search", "q=", "/?", "/advanced_search"]
+
+# links containing any of these are never useful
+BAD_LOCATIONS = ["facebook", "instagram",
+                 "linkedin", "twitter", "ratemyprofessors",
+                 "coursicle", "youtube", "amazon",
+                 ".doc", ".pdf", "wiki", "imgres"]
+
+# query parameters that only track where a click came from. They are removed
+#  so that the same page is not fetched once per way of reaching it
+TRACKING_PARAMS = re.compile(
+    r'^(?:utm_\w+|gclid|gclsrc|dclid|fbclid|msclkid|mc_cid|mc_eid|_ga|_gl'
+    r'|yclid|igshid|ref_src|spm)$', re.I
+)
+
+
+def _any_of(strings):
+    """
+    A compiled regex matching any of strings literally, or None if there are
+    none (an empty alternation would match everything).
+    """
+    strings = [s for s in strings if s]
+    if not strings:
+        return None
+    # the longest first, so that a string is never cut short by one of its
+    #  own prefixes
+    strings = sorted(set(strings), key=len, reverse=True)
+    return re.compile("|".join(re.escape(s) for s in strings))
+
+
+def unwrap(href):
+    """
+    Gets the address a google result link points to: '/url?q=<link>&sa=...'
+    becomes <link>. Any other href is returned as it is.
+    """
+    parts = urlsplit(href)
+    if parts.path == "/url" and (parts.netloc == ""
+                                 or parts.netloc.endswith("google.com")):
+        for key, value in parse_qsl(parts.query):
+            if key in ("q", "url"):
+                return value
+    return href
+
+
+def canonicalize(link):
+    """
+    Puts a link in one standard form: the scheme and host are lowercased,
+    default ports, fragments, and tracking parameters are dropped.
+
+    return: the canonical link, or None if link is not an absolute http(s)
+     address, which could not be fetched anyway
+    """
+    try:
+        parts = urlsplit(link.strip())
+        port = parts.port
+    except ValueError:
+        return None
+    scheme = parts.scheme.lower()
+    if scheme not in ("http", "https") or not parts.hostname:
+        return None
+
+    host = parts.hostname.lower()
+    if port is not None and port != {"http": 80, "https": 443}[scheme]:
+        host += ":" + str(port)
+    query = urlencode([(key, value) for key, value
+                       in parse_qsl(parts.query, keep_blank_values=True)
+                       if not TRACKING_PARAMS.match(key)])
+    return urlunsplit((scheme, host, parts.path or "/", query, ""))
+
+
+class UrlFilter:
+    """
+    Picks the useful links out of the anchors of a person's search results.
+    It is built once per run from the format's blocklist and useful sites,
+    with every list compiled into a single regex, and then applied to all of
+    a person's links at once.
+
+    Attributes:
+     blocked: the regex matching any bad location (and google's own pages)
+     prefixes: the regex matching any bad link prefix, at the start of a link
+     sites: the regex matching any of the useful sites, or None if there are
+      none
+
+    Methods:
+     clean: turns raw result hrefs into canonical links, dropping bad ones
+     select: keeps the links that look like they are about a person
+     filter: clean() followed by select()
+    """
+
+    def __init__(self, sites=(), bad_link_prefixes=BAD_LINK_PREFIXES,
+                 bad_locations=BAD_LOCATIONS):
+        self.prefixes = _any_of(bad_link_prefixes)
+        self.blocked = _any_of(list(bad_locations) + ["google.com"])
+        # researchgate is only useful when the person's name is in the link
+        #  too, which select() already requires of every link that is not on
+        #  a useful site
+        self.sites = _any_of([site.lower() for site in sites
+                              if site.lower() != "researchgate"])
+
+
+    def clean(self, hrefs):
+        """
+        hrefs: the href of every anchor of some search results
+        return: the canonical form of each useful link, without repeats, in
+         the order they were first found
+        """
+        links = []
+        for href in hrefs:
+            if self.prefixes is not None and self.prefixes.match(href):
+                continue
+            if self.blocked is not None and self.blocked.search(href):
+                continue
+            link = canonicalize(unwrap(href))
+            if link is None or "/search" in link:
+                continue
+            # an unwrapped link is checked again, as it was encoded before
+            if self.blocked is not None and self.blocked.search(link):
+                continue
+            links.append(link)
+        return list(dict.fromkeys(links))
+
+
+    def select(self, links, person):
+        """
+        Keeps the links that are on a useful site, or that contain the
+        person's first and last name, or their institution.
+
+        links: canonical links, as given by clean()
+        person: a dict containing the person's 'name' and 'institution'
+        """
+        full_name = person['name'].lower().split(" ")
+        first_name = full_name[0]
+        last_name = full_name[-1]
+        institution = person['institution'].lower()
+
+        selected = []
+        for link in links:
+            lowered = link.lower()
+            if (self.sites is not None and self.sites.search(lowered)) \
+               or (first_name in lowered and last_name in lowered) \
+               or institution in lowered:
+                selected.append(link)
+        return selected
+
+
+    def filter(self, hrefs, person):
+        return self.select(self.clean(hrefs), person)
@@ -0,0 +1,111 @@
+from collections import OrderedDict
+from concurrent.futures import Future
+import threading
+
+# how many pages the registry holds on to. Once it has more, the ones that
+#  were asked for the longest time ago are forgotten (and would be fetched
+#  again, or read from the page cache, if someone else needed them)
+MAX_PAGES = 200
+
+
+class UrlRegistry:
+    """
+    A run-wide record of every page fetched so far, keyed by canonical URL
+    (see url_filter.canonicalize()). People from the same institution often
+    turn up the same pages, such as department lists and lab rosters; the
+    first person to need a page fetches it, and everyone else gets the same
+    page_artifact.PageArtifact, waiting for it if it is still being fetched.
+    Once a page is fetched, the registry only keeps its text, and its anchors
+    if they are needed (see PageArtifact.slim()), so that the rendered html of
+    every page is not held in memory for the rest of the run.
+
+    A page that could not be fetched is handed to whoever was already waiting
+    for it, but is then forgotten, so a later person tries it again.
+
+    Attributes:
+     max_pages: the most pages kept
+     keep_anchors: whether the anchors of the pages kept are needed (they are
+      only used to find emails), and so worked out before the html is dropped
+     requested: how many pages have been asked for
+     fetched: how many of those had to be fetched
+
+    Methods:
+     claim: splits some links into the ones the caller has to fetch, and
+      gives a future for every link
+     resolve: hands a fetched page to everyone waiting for it
+     stats: a short string for the log
+    """
+
+    def __init__(self, max_pages=MAX_PAGES, keep_anchors=True):
+        self.max_pages = max_pages
+        self.keep_anchors = keep_anchors
+        self.pages = OrderedDict()
+        self.lock = threading.Lock()
+        self.requested = 0
+        self.fetched = 0
+
+
+    def claim(self, links):
+        """
+        return: (to_fetch, futures) where to_fetch is the list of links that
+         nobody has fetched or is fetching, which the caller now has to fetch
+         and resolve(), and futures is a dict of every link to the future of
+         its page
+        """
+        to_fetch = []
+        futures = {}
+        with self.lock:
+            for link in links:
+                self.requested += 1
+                future = self.pages.get(link)
+                if future is None:
+                    future = Future()
+                    self.pages[link] = future
+                    to_fetch.append(link)
+                    self.fetched += 1
+                else:
+                    self.pages.move_to_end(link)
+                futures[link] = future
+            self._evict()
+        return to_fetch, futures
+
+
+    def resolve(self, link, page):
+        """
+        Hands page, the artifact fetched for link, to everyone waiting for
+        it. Must be called exactly once for every link claim() said to fetch.
+        """
+        kept = None
+        if page.ok:
+            kept = Future()
+            kept.set_result(page.slim(self.keep_anchors))
+        with self.lock:
+            future = self.pages.get(link)
+            if future is not None and not future.done():
+                # whoever claims the link from now on gets the slim copy
+                if kept is not None:
+                    self.pages[link] = kept
+                else:
+                    del self.pages[link]
+        if future is not None and not future.done():
+            future.set_result(page)
+
+
+    def _evict(self):
+        """
+        Forgets the oldest fetched pages until at most max_pages are kept.
+        Pages still being fetched are kept. Must be called with the lock held.
+        """
+        excess = len(self.pages) - self.max_pages
+        if excess <= 0:
+            return
+        for link in [link for link, future in self.pages.items()
+                     if future.done()][:excess]:
+            del self.pages[link]
+
+
+    def stats(self):
+        saved = self.requested - self.fetched
+        return str(self.requested) + " pages needed, " + str(self.fetched) + \
+            " fetched, " + str(saved) + " fetches saved by sharing pages" \
+            " between people"